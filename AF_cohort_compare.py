@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Agreement between the annotator's gold standard and the AF detector over a whole cohort.
+
+    Pairs every file in the annotator's output directory (data_out, AF key with labels A/nAF and '-')
+    with the file of the same name in the AF detector's output directory (AF key, labels N, A, O, ~, -)
+    and compares each pair in a pool of worker processes. Per file and summed over the cohort:
+        confusion       duration weighted confusion matrix over N, A, O, ~, - and nAF (rows gold, columns
+                        machine, in hours), see Afib_annotation_compare.confusion_durations
+        kappa           Cohen's kappa of the AF / not AF matrix (and of the full matrix, kappa_labels)
+        sensitivity     AF duration sensitivity and PPV
+        episodes        gold AF episodes overlapping a machine AF episode (episode sensitivity) and machine
+                        AF episodes overlapping a gold AF episode (episode PPV), see compare_episodes
+    The report is written as one JSON file.
+
+    The comparison runs to the end of the recording when the waveform directory is given (rows of its time
+    index, waveform_store.TimeIndex, built once per recording), otherwise to one 30 s segment past the last label
+    of either file (default_end).
+
+    Major Dependencies:
+        Afib_annotation_compare  -episode and confusion matrix helpers
+        waveform_store           -TimeIndex
+
+    TO RUN:
+        python AF_cohort_compare.py /data_out /af --waves /files --workers 32 --out cohort_report.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from Afib_annotation_compare import LABELS, compare_episodes, confusion_durations, cohen_kappa
+from waveform_store import TimeIndex
+
+FS = 240 # rows per second of the waveforms the labels index
+
+# AF / not AF matrix (gold rows, machine columns) from the full confusion matrix, leaving out time either
+# marks as no signal ('-')
+def af_matrix(matrix, labels=LABELS):
+    af = np.array([lbl == 'A' for lbl in labels])
+    keep = np.array([lbl != '-' for lbl in labels])
+    sub = np.asarray(matrix)[np.ix_(keep, keep)]
+    af = af[keep]
+    return np.array([[sub[~af][:, ~af].sum(), sub[~af][:, af].sum()],
+                     [sub[af][:, ~af].sum(), sub[af][:, af].sum()]])
+
+def _ratio(a, b):
+    return float(a)/b if b else None
+
+# Agreement measures from summed counts (see compare_pair)
+def summarize(matrix, episodes):
+    matrix = np.asarray(matrix)
+    binary = af_matrix(matrix)
+    return {'hours': round(matrix.sum()/FS/3600, 3),
+            'confusion': pd.DataFrame(np.round(matrix/FS/3600, 4), index=LABELS, columns=LABELS).to_dict('index'),
+            'kappa': cohen_kappa(binary),
+            'kappa_labels': cohen_kappa(matrix),
+            'sensitivity': _ratio(binary[1, 1], binary[1].sum()),
+            'ppv': _ratio(binary[1, 1], binary[:, 1].sum()),
+            'episode_sensitivity': _ratio(episodes['gold_detected'], episodes['gold']),
+            'episode_ppv': _ratio(episodes['machine_confirmed'], episodes['machine']),
+            'episodes': episodes}
+
+# Compares one gold/machine pair in a worker. Returns (case, confusion matrix, episode counts, error)
+def compare_pair(case, gold_dir, machine_dir, wave_dir=None):
+    try:
+        gold = pd.read_hdf(os.path.join(gold_dir, case), key='AF')
+        machine = pd.read_hdf(os.path.join(machine_dir, case), key='AF')
+        time_index = TimeIndex.load(os.path.join(wave_dir, case)) if wave_dir is not None else None
+        end = time_index.nrows if time_index is not None else None
+        matrix = confusion_durations(gold, machine, end)
+        ep1, ep2, overlaps = compare_episodes(gold, machine, 'A', end, time_index)
+        episodes = {'gold': len(ep1), 'gold_detected': int(overlaps.ep1.nunique()),
+                    'machine': len(ep2), 'machine_confirmed': int(overlaps.ep2.nunique())}
+        return case, matrix, episodes, None
+    except Exception:
+        return case, None, None, traceback.format_exc()
+
+def _star_compare(args):
+    return compare_pair(*args)
+
+# Cases with both a gold standard and a machine file
+def paired_cases(gold_dir, machine_dir, extension='.hd5'):
+    return [case for case in sorted(os.listdir(gold_dir))
+            if case.endswith(extension) and os.path.isfile(os.path.join(machine_dir, case))]
+
+def compare_cohort(gold_dir, machine_dir, wave_dir=None, workers=os.cpu_count(), extension='.hd5'):
+    cases = paired_cases(gold_dir, machine_dir, extension)
+    print("Comparing", len(cases), "files with", workers, "workers")
+    t0 = time.time()
+    total = np.zeros((len(LABELS), len(LABELS)), dtype=np.int64)
+    total_episodes = dict.fromkeys(['gold', 'gold_detected', 'machine', 'machine_confirmed'], 0)
+    files, failed = {}, {}
+    with multiprocessing.Pool(workers) as pool:
+        jobs = [(case, gold_dir, machine_dir, wave_dir) for case in cases]
+        for case, matrix, episodes, error in pool.imap_unordered(_star_compare, jobs, chunksize=4):
+            if error is not None:
+                failed[case] = error
+                print('failed', case)
+                continue
+            total += matrix
+            for k in total_episodes:
+                total_episodes[k] += episodes[k]
+            files[case] = summarize(matrix, episodes)
+    report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'seconds': round(time.time()-t0, 1),
+              'gold_dir': gold_dir, 'machine_dir': machine_dir, 'labels': LABELS,
+              'files': len(files), 'cohort': summarize(total, total_episodes),
+              'per_file': {case: files[case] for case in sorted(files)}, 'failed': failed}
+    print("Done:", len(files), "Failed:", len(failed), "kappa:", report['cohort']['kappa'])
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare annotated AF with the AF detector output over a cohort.')
+    parser.add_argument('gold_dir', help='annotator output directory (data_out)')
+    parser.add_argument('machine_dir', help='AF detector output directory')
+    parser.add_argument('--waves', help='waveform directory, to compare up to the end of each recording')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='cohort_report.json')
+    args = parser.parse_args()
+    report = compare_cohort(args.gold_dir, args.machine_dir, args.waves, args.workers)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Saved', args.out)
+    sys.exit(bool(report['failed']))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+'''
+annotation_log.py
+    Append-only log of the labels made in the annotator, so no labelling is lost if the browser or server dies.
+
+    Every label is written to '<annotation file>.wal' as one JSON line, flushed and fsynced before the label is
+    shown as done:
+        {"start": 2000, "end": 3499, "label": "A", "annotator": "vt", "time": "2018-12-01 10:00:00"}
+    to_frame() compacts the log into the AF key format (index = start row, column 0 = label, a later label at the
+    same start replacing an earlier one), which the annotator writes to the annotation file only on save (the log,
+    not the annotation file, holds the labels until then, so labels already saved are never replaced unasked).
+    Opening a file whose log exists (not saved) replays it so labelling continues where it stopped; remove()
+    deletes the log once the labels have been saved.
+
+'''
+
+import os
+import json
+import time
+
+import pandas as pd
+
+class AnnotationLog:
+    '''
+    Labels of one annotation file (out_file), replayed from its log when one exists.
+        log = AnnotationLog(out_file, 'annotator name')
+        log.append(s_ind, e_ind, 'A')
+        log.to_frame().to_hdf(out_file, key='AF', format='t')
+        log.remove()
+    '''
+    def __init__(self, out_file, annotator=''):
+        self.path = out_file + '.wal'
+        self.annotator = annotator
+        self.labels = {} #start row -> label, the compacted log
+        self.events = 0
+        self.last_end = None #end row of the last label
+        self.file = None #opened on the first append so logs are only created for files being labelled
+        if os.path.isfile(self.path):
+            self.replay()
+
+    def replay(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError: #a line cut short by a crash
+                    continue
+                self.add(event)
+
+    def add(self, event):
+        self.labels[event['start']] = event['label']
+        self.last_end = event['end']
+        self.events += 1
+
+    # Writes the label of rows s_ind to e_ind to the log (durably) and adds it to the labels
+    def append(self, s_ind, e_ind, label):
+        event = {'start': int(s_ind), 'end': int(e_ind), 'label': label, 'annotator': self.annotator,
+                 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        if self.file is None:
+            self.file = open(self.path, 'a+')
+            if self.file.tell() > 0:
+                self.file.seek(self.file.tell()-1)
+                if self.file.read(1) != '\n': #end the line cut short by a crash
+                    self.file.write('\n')
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.add(event)
+
+    # Labels in the AF key format, sorted by start row
+    def to_frame(self):
+        starts = sorted(self.labels)
+        return pd.DataFrame({0: [self.labels[s] for s in starts]}, index=pd.Index(starts, dtype='int64'))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # Deletes the log (once its labels have been saved) and starts a new one
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.labels = {}
+        self.events = 0
+        self.last_end = None
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+'''
+catalog.py
+    Persistent catalog of the waveform files in the annotator's input directory.
+
+    The metadata of every hd5 file (rows, first and last time, duration, keys and Waveforms columns) and its
+    annotation status (annotated, last labelled row and progress through the recording) are kept in a SQLite
+    database, 'catalog.sqlite' in the annotation directory by default (the input directory may be a read-only
+    data mount). refresh() only opens the hdf files that are new or have changed (size or mtime) since they were
+    catalogued, and the annotation files likewise, so the file table loads without opening any hdf file once a
+    directory has been catalogued. When the database cannot be created or written the catalog is kept in memory
+    for the session instead.
+
+'''
+
+import os
+import json
+import sqlite3
+import threading
+
+import pandas as pd
+
+COLUMNS = ['name', 'path', 'ext', 'size_mb', 'mtime', 'nrows', 'start', 'end', 'duration', 'keys', 'columns',
+           'annotated', 'ann_mtime', 'labelled_rows', 'progress']
+
+class FileCatalog:
+    '''
+    Catalog of the hd5 files in hdf_path and of their annotations in af_path (a file of the same name).
+        catalog = FileCatalog(hdf_path, af_path)
+        df = catalog.refresh() #one row per file, columns COLUMNS
+    hdf files are only opened while holding 'lock' (the annotator's hdf_lock, as other threads read hdf files).
+    db_path is the SQLite file, '<af_path>/catalog.sqlite' by default.
+    '''
+    def __init__(self, hdf_path, af_path, db_path=None, extension='.hd5', key='Waveforms', lock=None):
+        self.hdf_path = hdf_path
+        self.af_path = af_path
+        self.lock = lock or threading.RLock()
+        self.extension = extension
+        self.key = key
+        self.db_path = db_path or os.path.join(af_path, 'catalog.sqlite')
+        try:
+            self.db = self.connect(self.db_path)
+        except sqlite3.OperationalError as e: #directory or database not writable
+            print("Could not open catalog", self.db_path, e, "- keeping it in memory")
+            self.db_path = ':memory:'
+            self.db = self.connect(self.db_path)
+
+    # Connection to the database at db_path with the files table, raises sqlite3.OperationalError unless writable
+    @staticmethod
+    def connect(db_path):
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        try:
+            db.execute('''CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, path TEXT, ext TEXT,
+                size_mb REAL, mtime REAL, nrows INTEGER, start TEXT, end TEXT, duration REAL, keys TEXT, columns TEXT,
+                annotated TEXT, ann_mtime REAL, labelled_rows INTEGER, progress REAL)''')
+            db.execute('PRAGMA user_version = 1') #a write, so a read-only database fails here and not in refresh()
+            db.commit()
+        except sqlite3.OperationalError:
+            db.close()
+            raise
+        return db
+
+    # Metadata of one hdf file, read from its table description and its first and last rows only
+    def read_metadata(self, file_path):
+        with self.lock, pd.HDFStore(file_path, mode='r') as hdf:
+            keys = hdf.keys()
+            nrows, start, end, duration, columns = 0, None, None, 0.0, []
+            if '/' + self.key in keys:
+                nrows = int(hdf.get_storer(self.key).nrows)
+            if nrows:
+                first = hdf.select(self.key, start=0, stop=1)
+                last = hdf.select(self.key, start=nrows-1, stop=nrows)
+                columns = list(first.columns) if isinstance(first, pd.DataFrame) else [first.name]
+                start, end = first.index[0], last.index[0]
+                duration = (end-start).total_seconds()
+                start, end = str(start), str(end)
+        return {'nrows': nrows, 'start': start, 'end': end, 'duration': duration,
+                'keys': json.dumps(keys), 'columns': json.dumps(columns)}
+
+    # Annotation status of a file given the nrows of its recording: the last labelled row and the fraction
+    # of the recording up to it
+    def read_annotation(self, ann_path, nrows):
+        try:
+            with self.lock:
+                df_AF = pd.read_hdf(ann_path, key='AF')
+        except (KeyError, OSError, ValueError):
+            return {'annotated': 'No', 'labelled_rows': 0, 'progress': 0.0}
+        last = int(df_AF.index[-1]) if len(df_AF) else 0
+        return {'annotated': 'Yes', 'labelled_rows': last, 'progress': round(last/nrows, 4) if nrows else 0.0}
+
+    # Brings the catalog up to date with the directories and returns it as a DataFrame sorted by name
+    def refresh(self):
+        known = {row[0]: row[1:] for row in self.db.execute('SELECT name, size_mb, mtime, ann_mtime, nrows FROM files')}
+        annotations = {e.name: e.stat().st_mtime for e in os.scandir(self.af_path) if e.is_file()} \
+            if os.path.isdir(self.af_path) else {}
+        seen = set()
+        for entry in os.scandir(self.hdf_path):
+            if not (entry.is_file() and entry.name.endswith(self.extension)):
+                continue
+            seen.add(entry.name)
+            stat = entry.stat()
+            size = round(stat.st_size/(1024*1024.0), 4)
+            ann_mtime = annotations.get(entry.name)
+            old = known.get(entry.name)
+            if old is None or old[0] != size or old[1] != stat.st_mtime:
+                try:
+                    row = self.read_metadata(entry.path)
+                except Exception as e: #unreadable or still being written, catalogue it as empty
+                    print("Could not read", entry.path, e)
+                    row = {'nrows': 0, 'start': None, 'end': None, 'duration': 0.0, 'keys': '[]', 'columns': '[]'}
+                row.update({'name': entry.name, 'path': self.hdf_path,
+                            'ext': os.path.splitext(entry.name)[1], 'size_mb': size, 'mtime': stat.st_mtime})
+                row.update(self.annotation_row(entry.name, ann_mtime, row['nrows']))
+                self.db.execute('INSERT OR REPLACE INTO files (%s) VALUES (%s)' % (', '.join(row), ', '.join('?'*len(row))),
+                                list(row.values()))
+            elif old[2] != ann_mtime:
+                row = self.annotation_row(entry.name, ann_mtime, old[3])
+                self.db.execute('UPDATE files SET %s WHERE name = ?' % ', '.join(k + ' = ?' for k in row),
+                                list(row.values()) + [entry.name])
+        gone = [name for name in known if name not in seen]
+        self.db.executemany('DELETE FROM files WHERE name = ?', [(name,) for name in gone])
+        self.db.commit()
+        return self.to_frame()
+
+    def annotation_row(self, name, ann_mtime, nrows):
+        row = {'annotated': 'No', 'labelled_rows': 0, 'progress': 0.0} if ann_mtime is None else \
+            self.read_annotation(os.path.join(self.af_path, name), nrows)
+        row['ann_mtime'] = ann_mtime
+        return row
+
+    def to_frame(self):
+        return pd.read_sql_query('SELECT %s FROM files ORDER BY name' % ', '.join(COLUMNS), self.db)
+
+    def close(self):
+        self.db.close()
@@ -11,14 +11,25 @@ helpers.py
 '''
 
 import os
+import sys
+import threading
+import numpy as np
 import pandas as pd
 import itertools
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from bokeh.layouts import widgetbox
 from bokeh.models import ColumnDataSource
 from bokeh.models.widgets import TableColumn
 from bokeh.palettes import Category10
 
+from catalog import FileCatalog
+from annotation_log import AnnotationLog
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #repo root, for waveform_store
+from waveform_store import open_waveforms, save_npz, TimeIndex
+
 
 #import waveform
 
@@ -29,23 +40,27 @@ def get_files(path):
             size = round(os.path.getsize(os.path.join(path, file)) / (1024*1024.0),4) #>> 20 #to get in mb
             yield file,path,size
 
-#load in paths for hdf and summary files
-def load_file_source(hdf_path, af_path): #--> move to callbacks??
-    dict_hdf = {"name": [], "hdf_full_path": [], "hdf_type": [], "annotated": []} #"hdf_size": [], "annotated":[]}
-    for file,path,size in get_files(hdf_path):
-        if file.endswith(".hd5"):
-            base = os.path.splitext(file)[0]
-            extension = os.path.splitext(file)[1]
-            dict_hdf['name'].append(base)
-            dict_hdf["hdf_full_path"].append(path)
-            dict_hdf["hdf_type"].append(extension)
-            dict_hdf["annotated"].append(get_if_annotated(file, af_path))
+#load in paths for hdf and summary files, from the file catalog (see catalog.py) which only opens new or changed files
+#db_path is the catalog database (see catalog.py), by default in af_path
+def load_file_source(hdf_path, af_path, db_path=None): #--> move to callbacks??
+    catalog = FileCatalog(hdf_path, af_path, db_path, lock=hdf_lock) #one file at a time, between the executor's reads
+    files = catalog.refresh()
+    catalog.close()
+    dict_hdf = {"name": [os.path.splitext(f)[0] for f in files['name']],
+                "hdf_full_path": list(files['path']),
+                "hdf_type": list(files['ext']),
+                "annotated": list(files['annotated']),
+                "duration": ['%d:%02d:%02d' % (d//3600, d%3600//60, d%60) for d in files['duration'].fillna(0)],
+                "nrows": list(files['nrows']),
+                "progress": ['%.0f%%' % (100*p) for p in files['progress'].fillna(0)]}
     result = pd.DataFrame(dict_hdf)
     source = ColumnDataSource(result)
     columns = [
         TableColumn(field="name", title="File"),
         TableColumn(field="hdf_type", title="File Type"),
+        TableColumn(field="duration", title="Duration"),
         TableColumn(field="annotated",title="Annotated"),
+        TableColumn(field="progress", title="Progress"),
     ]
     return source,columns
 
@@ -128,6 +143,362 @@ def get_data_for_graph(hdfs,key,cols):
         chunks = read_in_chunks(hdfs, key, cols)
     print("Done")
 
+#---------------BACKGROUND WORK --------------------#
+executor = ThreadPoolExecutor(max_workers=4) #shared by every session of the server (helpers is imported once)
+save_executor = ThreadPoolExecutor(max_workers=1) #annotation writes, one at a time in the order they were made
+hdf_lock = threading.RLock() #the HDF5 library is not thread safe, one read or write at a time
+
+#Runs func(*args) on the executor (or on 'pool'), then done(result, error) on the next tick of the Bokeh
+#document doc, where it can update the models (error is None or the exception func raised).
+#keep(result), when given, runs first on the executor thread; if it returns False the result is not wanted any
+#more (the session has ended, see AnnotatorSession.keep_file) and done is not scheduled
+def run_in_background(doc, done, func, *args, pool=None, keep=None):
+    def finished(future):
+        error = future.exception()
+        if error is None and keep is not None and not keep(future.result()):
+            return
+        doc.add_next_tick_callback(partial(done, None if error else future.result(), error))
+    (pool or executor).submit(func, *args).add_done_callback(finished)
+
+#---------------WINDOWED WAVEFORM READING --------------------#
+class WaveformWindow:
+    '''
+    Reads rows of one lead of the Waveforms table (or its parquet cache, see waveform_store.py) on demand instead
+    of loading the whole recording.
+    Frames have the absolute row numbers of the table as index and 'date' and 'II' columns (like newECG did).
+    One block is cached: each read that misses it reads the requested rows plus 'prefetch' rows after them,
+    so stepping through the recording view by view reads the file once with bounded memory.
+    '''
+    def __init__(self, path, key='Waveforms', column='II', prefetch=100000, reader=None, time_index=None):
+        self.shared = reader is not None #a reader from WaveformCache, left open on close()
+        self.time_index = time_index #TimeIndex of the recording, for rows_between
+        with hdf_lock:
+            self.wf = reader if self.shared else open_waveforms(path, key)
+        self.nrows = self.wf.nrows
+        self.column = column
+        self.prefetch = prefetch
+        self.cache = None
+
+    # Rows start to stop (clipped to the table). With cache=False the rows are read without prefetch and not
+    # kept (for one-off reads of large ranges)
+    def read(self, start, stop, cache=True):
+        start, stop = max(int(start), 0), min(int(stop), self.nrows)
+        if not cache:
+            with hdf_lock:
+                times, values = self.wf.read(start, stop, self.column)
+            return pd.DataFrame({'date': times, 'II': values}, index=pd.RangeIndex(start, start+len(times)))
+        if self.cache is None or start < self.cache.index[0] or stop > self.cache.index[-1]+1:
+            with hdf_lock:
+                times, values = self.wf.read(start, min(stop+self.prefetch, self.nrows), self.column)
+            self.cache = pd.DataFrame({'date': times, 'II': values}, index=pd.RangeIndex(start, start+len(times)))
+        return self.cache.loc[start:stop-1]
+
+    # Stored time (datetime64) of row
+    def time_at(self, row):
+        with hdf_lock:
+            return self.wf.read_times(int(row), int(row)+1)[0]
+
+    # First and last row with start_dt < date <= end_dt, by binary search in the time index when there is one,
+    # else in the cached block when it covers the range, otherwise by the reader. Raises IndexError when no row is in the range
+    def rows_between(self, start_dt, end_dt):
+        if self.time_index is not None:
+            with hdf_lock: #the stored times around the rows found are read to check them
+                return self.time_index.rows_between(start_dt, end_dt, self.wf)
+        dates = self.cache['date'].values if self.cache is not None else None
+        t0, t1 = pd.Timestamp(start_dt).to_datetime64(), pd.Timestamp(end_dt).to_datetime64()
+        if dates is not None and len(dates) and dates[0] <= t0 and t1 < dates[-1]:
+            a = np.searchsorted(dates, t0, 'right')
+            b = np.searchsorted(dates, t1, 'right')
+            rows = self.cache.index[a:b]
+        else:
+            with hdf_lock:
+                return self.wf.rows_between(t0, t1)
+        return rows[0], rows[-1]
+
+    def close(self):
+        self.cache = None
+        if not self.shared:
+            with hdf_lock:
+                self.wf.close()
+
+#---------------MIN/MAX PYRAMID --------------------#
+class MinMaxPyramid:
+    '''
+    Min/max decimation of one lead at several resolutions, so a plot never gets more points than it has pixels.
+    Level 0 holds the min and max of every 'bucket' rows, level k of every bucket*factor**k rows, up to a level
+    of at most 'top' buckets. 'times' is the time (ns) of the first row of each level 0 bucket.
+    Built once per recording and cached next to it ('<file>.minmax.npz'), rebuilt when the recording is newer.
+    '''
+    def __init__(self, nrows, times, mins, maxs, bucket=16, factor=4):
+        self.nrows = nrows
+        self.times = times
+        self.mins = mins # one array per level
+        self.maxs = maxs
+        self.bucket = bucket
+        self.factor = factor
+
+    @staticmethod
+    def cache_path(path):
+        return os.path.splitext(path)[0] + '.minmax.npz'
+
+    # Reads the lead in chunks of chunk_rows rows (a multiple of bucket) and reduces it level by level.
+    # progress(fraction) is called after every chunk when given
+    @classmethod
+    def build(cls, path, key='Waveforms', column='II', bucket=16, factor=4, top=2000, chunk_rows=2**21, progress=None):
+        times, mins, maxs = [], [], []
+        with hdf_lock:
+            wf = open_waveforms(path, key)
+            nrows = wf.nrows
+        try:
+            for start in range(0, nrows, chunk_rows):
+                with hdf_lock: #released between chunks so other sessions' reads are not held up
+                    block_times, values = wf.read(start, min(start+chunk_rows, nrows), column)
+                values = np.asarray(values, dtype=np.float32)
+                pad = -len(values) % bucket
+                values = np.append(values, np.full(pad, np.nan, np.float32)).reshape(-1, bucket)
+                times.append(block_times[::bucket].astype('datetime64[ns]').view(np.int64))
+                mins.append(np.fmin.reduce(values, axis=1)) #fmin/fmax skip NaNs, all NaN buckets stay NaN
+                maxs.append(np.fmax.reduce(values, axis=1))
+                if progress is not None:
+                    progress(min(start+chunk_rows, nrows)/nrows)
+        finally:
+            with hdf_lock:
+                wf.close()
+        mins, maxs = [np.concatenate(mins)], [np.concatenate(maxs)]
+        while len(mins[-1]) > top:
+            pad = -len(mins[-1]) % factor
+            mins.append(np.fmin.reduce(np.append(mins[-1], np.full(pad, np.nan, np.float32)).reshape(-1, factor), axis=1))
+            maxs.append(np.fmax.reduce(np.append(maxs[-1], np.full(pad, np.nan, np.float32)).reshape(-1, factor), axis=1))
+        return cls(nrows, np.concatenate(times), mins, maxs, bucket, factor)
+
+    # Cached pyramid of the recording at 'path', built (and saved when the directory is writable) if missing or stale
+    @classmethod
+    def load(cls, path, **kwargs):
+        cache = cls.cache_path(path)
+        if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+            with np.load(cache) as f:
+                levels = int(f['levels'])
+                return cls(int(f['nrows']), f['times'], [f['min_%d' % k] for k in range(levels)],
+                           [f['max_%d' % k] for k in range(levels)], int(f['bucket']), int(f['factor']))
+        pyramid = cls.build(path, **kwargs)
+        try:
+            arrays = {'min_%d' % k: m for k, m in enumerate(pyramid.mins)}
+            arrays.update({'max_%d' % k: m for k, m in enumerate(pyramid.maxs)})
+            save_npz(cache, nrows=pyramid.nrows, times=pyramid.times, levels=len(pyramid.mins),
+                     bucket=pyramid.bucket, factor=pyramid.factor, **arrays)
+        except OSError as e:
+            print("Could not save", cache, e)
+        return pyramid
+
+    # Row at (or just before) the time t in ms since the epoch, as given by a Bokeh datetime range
+    def row_at(self, t):
+        k = np.searchsorted(self.times, np.int64(round(t*1e6)), 'right')-1
+        return int(min(max(k, 0)*self.bucket, self.nrows))
+
+    # Finest level with at most 'width' buckets between rows start and stop, None if the raw rows fit
+    def level_for(self, start, stop, width):
+        if stop-start <= 2*width:
+            return None
+        for level in range(len(self.mins)):
+            if (stop-start)/(self.bucket*self.factor**level) <= width:
+                return level
+        return len(self.mins)-1
+
+    # Bucket first rows, times (datetime64) and min and max of 'level' between rows start and stop
+    def view(self, level, start, stop):
+        size = self.bucket*self.factor**level
+        a, b = start//size, -(-stop//size)
+        rows = np.arange(a, b)*size
+        return rows, self.times[rows//self.bucket].view('datetime64[ns]'), self.mins[level][a:b], self.maxs[level][a:b]
+
+ANNOTATION_STYLES = [('~', 'Noise', 'blue'), ('N', 'Normal', 'green'), ('O', 'Other', 'purple'),
+                     ('A', 'AF', 'red'), ('-', 'No Signal', 'black'), ('nAF', 'Not AF', 'grey')]
+
+#Data for a ColumnDataSource of lead II between rows start and stop, at most about 'width' points wide:
+#the raw rows (read through window, a WaveformWindow) when they fit, otherwise the min/max of the pyramid level
+#that does, drawn as a vertical stroke per bucket. The rows are padded by half the range on both sides so small
+#pans need no new data. With df_AF (AF key) each label of ANNOTATION_STYLES gets a column that is II where the
+#row (bucket) has that label and NaN elsewhere, so one line per label can be drawn
+def plot_data(pyramid, window, start, stop, width, df_AF=None):
+    pad = (stop-start)//2
+    start, stop = max(start-pad, 0), min(stop+pad, pyramid.nrows)
+    level = pyramid.level_for(start, stop, width)
+    if level is None:
+        frame = window.read(start, stop, cache=False)
+        rows, x, y = frame.index.values, frame['date'].values, frame['II'].values
+    else:
+        rows, times, mins, maxs = pyramid.view(level, start, stop)
+        rows, x = np.repeat(rows, 2), np.repeat(times, 2)
+        y = np.column_stack([mins, maxs]).ravel()
+    data = {'index': x, 'II': y}
+    if df_AF is not None:
+        codes = label_codes(df_AF, rows)
+        for code, (lbl, name, colour) in enumerate(ANNOTATION_STYLES):
+            data[lbl] = np.where(codes == code, y, np.nan)
+    return data
+
+#Code (index into ANNOTATION_STYLES, -1 for unknown labels) of each label in the AF key
+def annotation_codes(df_AF):
+    codes = {lbl: code for code, (lbl, name, colour) in enumerate(ANNOTATION_STYLES)}
+    return np.array([codes.get(lbl, -1) for lbl in df_AF[0].values], dtype=np.int8)
+
+#Label code of each row in rows (sorted or not) given the AF key, -1 before the first label
+def label_codes(df_AF, rows):
+    k = np.searchsorted(df_AF.index.values, rows, 'right')-1
+    return np.where(k >= 0, annotation_codes(df_AF)[np.maximum(k, 0)], -1)
+
+#---------------SESSIONS --------------------#
+class WaveformCache:
+    '''
+    Open readers, min/max pyramids and time indexes shared by the sessions of the server, one per file however many sessions
+    have it open. acquire() counts a reference and release() drops it; the entry is closed and freed when the last
+    session using the file releases it. The pyramid arrays are made read-only as every session sees the same ones.
+    A file is opened by one session at a time: others asking for it meanwhile wait for that open and share it.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} #path -> [reader, pyramid, time index, references]
+        self.opening = {} #path -> threading.Event set when the session opening it is done
+
+    # (reader, pyramid, time index) of path, opening it (building the pyramid and time index if needed) when no
+    # session has it open. When the open of another session fails the next waiting session tries again
+    def acquire(self, path, progress=None):
+        while True:
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None:
+                    entry[3] += 1
+                    return tuple(entry[:3])
+                opening = self.opening.get(path)
+                if opening is None:
+                    opening = self.opening[path] = threading.Event()
+                    break
+            opening.wait()
+        try:
+            with hdf_lock:
+                reader = open_waveforms(path)
+            try:
+                time_index = TimeIndex.load(path, lock=hdf_lock) #built chunk by chunk, other sessions read in between
+                pyramid = MinMaxPyramid.load(path, progress=progress)
+            except BaseException:
+                with hdf_lock:
+                    reader.close()
+                raise
+            for array in [pyramid.times] + pyramid.mins + pyramid.maxs:
+                array.flags.writeable = False
+            with self.lock:
+                entry = self.entries[path] = [reader, pyramid, time_index, 1]
+                return tuple(entry[:3])
+        finally:
+            with self.lock:
+                del self.opening[path]
+            opening.set()
+
+    def release(self, path):
+        with self.lock:
+            entry = self.entries[path]
+            entry[3] -= 1
+            if entry[3] > 0:
+                return
+            del self.entries[path]
+        with hdf_lock:
+            entry[0].close()
+
+waveform_cache = WaveformCache() #module level so every session of the server shares it
+
+class AnnotatorSession:
+    '''
+    State of one browser session of the annotator: the file open (a WaveformWindow on the shared reader and the
+    shared pyramid), the annotation output file and the labels made so far (log, an AnnotationLog).
+    Opens run in parallel on the executor, so each is numbered (request_open) and only the result of the latest
+    request is kept, whichever finishes last.
+    close() (from the document's on_session_destroyed) releases the file and closes the log.
+    '''
+    def __init__(self):
+        self.wave_file = None
+        self.window = None
+        self.pyramid = None
+        self.out_file = None
+        self.log = None
+        self.closed = False
+        self.opened = [] #(request, result) of open_file waiting for set_file on the next tick
+        self.requests = 0 #number of the latest open request
+        self.lock = threading.Lock()
+
+    # Number of a new open request, making the results of earlier ones stale
+    def request_open(self):
+        with self.lock:
+            self.requests += 1
+            return self.requests
+
+    def is_latest(self, request):
+        with self.lock:
+            return request == self.requests
+
+    # Opens path through waveform_cache, on the executor (see set_file). Returns (path, window, pyramid)
+    @staticmethod
+    def open_file(path, progress=None):
+        reader, pyramid, time_index = waveform_cache.acquire(path, progress)
+        return path, WaveformWindow(path, reader=reader, time_index=time_index), pyramid
+
+    @staticmethod
+    def discard_file(result):
+        path, window, pyramid = result
+        window.close()
+        waveform_cache.release(path)
+
+    # keep argument of run_in_background for open_file (with partial, the number of its request): holds the file
+    # until set_file takes it, or releases it straight away when the session has ended (Bokeh may never run
+    # callbacks of a destroyed document) or a later open was requested
+    def keep_file(self, request, result):
+        with self.lock:
+            if not self.closed and request == self.requests:
+                self.opened.append((request, result))
+                return True
+        self.discard_file(result)
+        return False
+
+    # Makes the result of open_file the session's file, releasing the previous one. Returns False when the
+    # session ended while the file was opening (close() has released it) or when a later open was requested
+    # meanwhile (the file is released)
+    def set_file(self, path, window, pyramid):
+        with self.lock:
+            held = [(request, r) for request, r in self.opened if r[1] is window]
+            self.opened = [(request, r) for request, r in self.opened if r[1] is not window]
+            if self.closed or not held:
+                return False
+            stale = held[0][0] != self.requests
+        if stale:
+            self.discard_file(held[0][1])
+            return False
+        self.release()
+        self.wave_file, self.window, self.pyramid = path, window, pyramid
+        return True
+
+    def release(self):
+        if self.wave_file is not None:
+            self.window.close()
+            waveform_cache.release(self.wave_file)
+        self.wave_file, self.window, self.pyramid = None, None, None
+
+    # Starts labelling out_file, replaying the labels in its log when it was not saved
+    def open_log(self, out_file, annotator=''):
+        if self.log is not None:
+            self.log.close()
+        self.out_file = out_file
+        self.log = AnnotationLog(out_file, annotator)
+        return self.log
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            opened, self.opened = self.opened, []
+        for request, result in opened:
+            self.discard_file(result)
+        self.release()
+        if self.log is not None:
+            self.log.close()
+
 # Returns the time difference between two datetimes in hours, minutes and seconds respectively
 def duration_HMS(start, stop):
     duration = (stop-start).total_seconds()
@@ -35,7 +35,7 @@ Waveform annotator
         bokeh serve --show AFAnnotator4
 '''
 
-#import numpy as np
+import numpy as np
 import pandas as pd
 #import time
 #import datetime
@@ -57,6 +57,7 @@ from bokeh.events import ButtonClick
 from bokeh.models.ranges import Range1d
 
 import sys
+from functools import partial
 
 from helpers import *
 
@@ -70,18 +71,22 @@ def main():
     #af_outpath = '/mnt/data04/Conduit/afib/AF_annotations/af_ann4/'
     in_path = join(dirname(__file__), "data_in/")
     af_outpath = join(dirname(__file__), "data_out/")
+    catalog_path = join(af_outpath, "catalog.sqlite") #file catalog, not in in_path as that may be read-only
     #Miscellaneous variables
     colours = {'':'black','O':'blue','N':'green','~':'purple','A':'red'}
     #wf_classes = ['AF','Normal','Other','Noise','No Signal']
     wf_classes = ['AF', 'Not AF']
-    #global variables remove if you can
-    newECG = pd.DataFrame()
-    df_ann = pd.DataFrame(columns=[0])
+    plot_width = 1400
+    doc = curdoc() #this session's document, background work reports back through its next tick callbacks
+    #state of this session: open file (window and pyramid shared with other sessions), out_file and label log
+    session = AnnotatorSession()
+    doc.on_session_destroyed(lambda session_context: session.close())
 
     #widgets to be used as necessary
     rdo_btn_wave_lbls = RadioButtonGroup(labels = wf_classes, active=2)
+    txt_annotator = TextInput(title="Annotator", value='')
     date_range_slider = Slider(title="Date Range", step=10)
-    table_source, table_columns = load_file_source(in_path, af_outpath)
+    table_source, table_columns = load_file_source(in_path, af_outpath, catalog_path)
     file_table = DataTable(source=table_source, columns=table_columns, width=800, height=600)
     pgph_file_loaded = Div(text="Select file from table.", width=1000,height=50)
     pgph_file_loaded.style = {"font-size": '1.2em', 'font-weight': 'bold', 'color': 'SteelBlue'}
@@ -104,21 +109,45 @@ def main():
         Update the Tab Pane with this new layout.
         Returns: Nothing'''
     def callback_select_file_table(attr,old,new):
-        global newECG, out_file
         #clear tabs graphs to reduce overhead
         output_tab.child.children = []
         sel_id = new
-        txt_processing.text = "Use slider to select segments, label by selecting the wave type and pressing 'Label'. Use the save button to when done."
         txt_processing.style = {"font-size": '1.2em','color': 'SteelBlue'}
         wave_file_path = load_selected_file(table_source,sel_id)
         out_file = load_annotation_file(table_source, sel_id, af_outpath) #to be used for saving the file
         pgph_file_loaded.text = "Processing..."
-        wave_hdfs, hdfs_keys = load_hd5_file(wave_file_path)
-        print(hdfs_keys)
-        newECG = (wave_hdfs.select(key='Waveforms').II).to_frame() #get lead II from waveforms)
-        newECG.reset_index(inplace=True) #move datetime index to column and reset the index
-        newECG.columns = ['date', 'II']
-        wave_hdfs.close()
+        txt_processing.text = "Opening file..."
+        btn_save.disabled = True
+        btn_lbl.disabled = True
+        btn_load_annotated_graph.disabled = True
+        #read the file on the executor, file_opened then shows it
+        #lead II from waveforms, read a window at a time, and its min/max pyramid, which is built on the first
+        #open of a file (with progress shown) and then read from the cache. Shared with other sessions on the file
+        #only the latest request is shown when several files are opening (the others are released)
+        request = session.request_open()
+        progress = lambda fraction: show_progress('Preparing file for display... %d%%' % (100*fraction))
+        run_in_background(doc, partial(file_opened, request, sel_id, out_file), session.open_file, wave_file_path,
+                          progress, keep=partial(session.keep_file, request))
+
+    ''' Set txt_processing from any thread (on the next tick of this session's document). '''
+    def show_progress(text):
+        def update():
+            txt_processing.text = text
+        doc.add_next_tick_callback(update)
+
+    ''' Done callback of session.open_file: swap in the new file and create its figure. '''
+    def file_opened(request, sel_id, out_file, result, error):
+        if error is not None:
+            if not session.is_latest(request): #another file was selected meanwhile
+                return
+            pgph_file_loaded.text = "Could not open file: %s" % error
+            txt_processing.text = ''
+            return
+        if not session.set_file(*result): #the session ended or another file was selected meanwhile
+            return
+        print(session.window.nrows, "rows")
+        log = session.open_log(out_file, txt_annotator.value) #labels not saved last time are replayed
+        txt_processing.text = "Use slider to select segments, label by selecting the wave type and pressing 'Label'. Use the save button to when done."
         #enable the buttons if disabled
         btn_save.disabled = False
         btn_lbl.disabled = False
@@ -129,9 +158,14 @@ def main():
             txt_processing.text = 'This file has already been annotated. If you save this file again you will overwrite previous data.'
             txt_processing.style = {"font-size": '1.2em','color': 'Red'}
             btn_load_annotated_graph.disabled = False
-        #create figure
+        #create figure, where labelling stopped when resuming
         print("*********************Creating Figure (in Callback File Select)")
-        get_next_graph(0,newECG)
+        if log.events:
+            txt_processing.text = 'Resumed %d labels not saved last time. Save to write them to the annotation file.' % log.events
+            txt_processing.style = {"font-size": '1.2em','color': 'Red'}
+            get_next_graph(log.last_end, session.window)
+        else:
+            get_next_graph(0,session.window)
         pgph_file_loaded.text = "File loaded, navigate Label Data Tab to annotate lead II."
 
 
@@ -139,40 +173,41 @@ def main():
         Update the output_tab to show this figure.
         Disable some buttons to keep users on track. '''
     def load_output_graph():
-        global newECG
         btn_save.disabled = True
         btn_lbl.disabled = True
         btn_load_annotated_graph.disabled = True
         txt_processing.text = 'Loading Plot...'
-        df_AF = pd.read_hdf(out_file)
-        noise, normal, other, af, nosig, notAF = load_annotations(0, df_AF.shape[0]-1, newECG, df_AF)
-        output_graph = get_graph_annotated(noise, normal, other, af, nosig, notAF)
-        output_tab.child.children = [output_graph]
-        txt_processing.text = 'Plot loaded, navigate to "Final Annotated Graph" tab to view. &#10 If you save this file again you will overwrite previous data.'
+        run_in_background(doc, output_graph_loaded, read_annotated, session.out_file, session.window, session.pyramid)
+
+    ''' Runs on the executor: read the annotations and the data of the annotated graph.
+        Returns: df_AF, plot data '''
+    def read_annotated(ann_file, window, pyr):
+        with hdf_lock:
+            df_AF = pd.read_hdf(ann_file)
+        return df_AF, plot_data(pyr, window, 0, window.nrows, plot_width, df_AF)
+
+    def output_graph_loaded(result, error):
         btn_save.disabled = False
         btn_lbl.disabled = False
+        if error is not None:
+            txt_processing.text = 'Could not load plot: %s' % error
+            btn_load_annotated_graph.disabled = False
+            return
+        df_AF, data = result
+        output_graph = get_graph_annotated(ColumnDataSource(data), df_AF)
+        output_tab.child.children = [output_graph]
+        txt_processing.text = 'Plot loaded, navigate to "Final Annotated Graph" tab to view. &#10 If you save this file again you will overwrite previous data.'
 
-    def get_next_graph(sind, df):
+    def get_next_graph(sind, window):
         length=20000#7200
-        eind = sind+length
-        if eind <= list(df.index)[-1] and sind < list(df.index)[-1]: #as long as the end and beginning are less than the end of the dataframe
-            sub_df = df.iloc[sind:eind]
-            sub_df = sub_df.set_index('date')
-            del sub_df.index.name
-            source = ColumnDataSource(sub_df)
-            wave_graph = get_graph(source)
-            start_span, end_span = add_span(source)
-            wave_graph.add_layout(start_span)
-            wave_graph.add_layout(end_span)
-            start_rng = start_span.location
-            end_rng = end_span.location
-        elif eind < list(df.index)[-1] and sind < list(df.index)[-1]: #if the start is before but the end is after then just use the end of the dataframe
-            sub_df = df.iloc[sind:list(df.index)[-1]]
-            sub_df = sub_df.set_index('date')
-            del sub_df.index.name
-            source = ColumnDataSource(sub_df)
-            wave_graph = get_graph(source)
-            start_span, end_span = add_span(source)
+        eind = min(sind+length, window.nrows) #use the end of the recording if the view runs past it
+        if sind < window.nrows-1:
+            #only these rows (padded to allow small pans) are read, or their min/max when there are more than the
+            #plot has pixels. The spans, slider and view are over the rows sind to eind-1 themselves
+            source = ColumnDataSource(plot_data(session.pyramid, window, sind, eind, plot_width))
+            start, end = to_ms(window.time_at(sind)), to_ms(window.time_at(eind-1))
+            wave_graph = get_graph(source, start, end)
+            start_span, end_span = add_span(start, end)
             wave_graph.add_layout(start_span)
             wave_graph.add_layout(end_span)
             start_rng = start_span.location
@@ -192,7 +227,7 @@ def main():
                     style={'display':'block','height': '1px', 'border': '0', 'border-top': '1px solid #css',
                             'margin': '1em 0', 'padding': '0'}),
                     width=1400),
-            widgetbox([rdo_btn_wave_lbls,btn_lbl], width=300),
+            widgetbox([txt_annotator,rdo_btn_wave_lbls,btn_lbl], width=300),
             widgetbox(date_range_slider, width=1350),
             widgetbox(Div(text="""<hr/>""",
                     style={'display':'block','height': '1px', 'border': '0', 'border-top': '1px solid #css',
@@ -202,13 +237,14 @@ def main():
         )
         wf_tab.child.children = [graph_layout]
 
-    ''' Use a ColumnDataSource to plot the ECG lead II waveform data in a line plot.
-        Parameters: source a ColumnDataSource
+    ''' Use a ColumnDataSource to plot the ECG lead II waveform data in a line plot, showing start to end.
+        Parameters: source a ColumnDataSource, start and end timetuple integers
         Returns: p a Bokeh figure '''
-    def get_graph(source):
-        p = figure(plot_width=1400, plot_height=500,x_axis_type='datetime', tools=['zoom_in','zoom_out', 'xpan', 'ypan'])
-        date_range = source.data['II'][0:20000]
-        p.y_range = Range1d(start=min(date_range)-1,end=max(date_range)+1)
+    def get_graph(source, start, end):
+        p = figure(plot_width=plot_width, plot_height=500,x_axis_type='datetime', tools=['zoom_in','zoom_out', 'xpan', 'ypan'])
+        date_range = source.data['II']
+        p.y_range = Range1d(start=np.nanmin(date_range)-1,end=np.nanmax(date_range)+1)
+        p.x_range = Range1d(start=start, end=end)
         dt_axis_format = ["%d-%m-%Y %H:%M"]
         wf_x_axis = DatetimeTickFormatter(
                 hours=dt_axis_format,
@@ -218,24 +254,35 @@ def main():
         )
         p.xaxis.formatter = wf_x_axis
         p.line(x='index', y='II', source=source,line_color='black', line_width=1)
+        refine_on_range(p, source)
         return p
 
+    ''' Replace the data of source (plotted in p) when the x range changes so that zooming in shows more detail
+        (down to the raw rows) and zooming out fewer points. df_AF for the annotated graph. '''
+    def refine_on_range(p, source, df_AF=None):
+        def callback_x_range(attr, old, new):
+            pyramid = session.pyramid
+            if pyramid is None: #file closed
+                return
+            start, end = pyramid.row_at(p.x_range.start), pyramid.row_at(p.x_range.end)
+            source.data = plot_data(pyramid, session.window, start, end+pyramid.bucket, plot_width, df_AF)
+        p.x_range.on_change('end', callback_x_range)
+
 
     ''' Get the first and last time points from the ColumnDataSource (source).
         Utlizes tzlocal to add an offset which modifies the data.
         Returns integer timetuple value for the dates found: start, end '''
     def get_time(source):
-        start = pd.to_datetime(min(source.data['index'])).timestamp()*1000
-        end = pd.to_datetime(max(source.data['index'])).timestamp()*1000
-        return start, end
+        return to_ms(min(source.data['index'])), to_ms(max(source.data['index']))
+
+    ''' Integer timetuple value (ms) of a date, as used by the spans and slider. '''
+    def to_ms(date):
+        return pd.to_datetime(date).timestamp()*1000
 
 
-    ''' Generate two Bokeh Spans based on the ColumnDataSource given (source).
-        Spans are at the first and last datetimes in the source data.
-        Parameters: source a ColumnDataSource
+    ''' Generate two Bokeh Spans at start and end (timetuple integers).
         Returns: Span, Span '''
-    def add_span(source):
-        start, end = get_time(source)
+    def add_span(start, end):
         # Start span represents the start of the area of interest
         start_span = Span(location=start,
                     dimension='height', line_color='green',
@@ -275,45 +322,31 @@ def main():
         
     ''' Function to get ECG data between two Spans (after modifying the timetuple to timestamp).
         Call apply_annotations using start and end indexes found.
-        Modify the global df_ann variable.
+        Add the label to the session's log.
         Update slider position (start to end), (end to start).
         Parameters: label a string (AF, Normal, Noise, Other), start a timpletuple integer, end a timetuple integer
         Return: nothing '''
     def segment_and_label(label, start, end):
-        global newECG
         print("*********************Segmenting and Labelling")
         try:
             txt_processing.text = "Use slider to select segments, label by selecting the wave type and pressing 'Label'. Use the save button to when done."
             start_dt = pd.Timestamp(start/1000,unit='s')
             end_dt = pd.Timestamp(end/1000, unit='s')
-            mask = (newECG['date'] > start_dt) & (newECG['date'] <= end_dt)
-            df_sub = newECG.loc[mask] #apply mask
-            indexes = list(df_sub.index) #get indexes
-            s_ind = indexes[0]  #get first index
-            e_ind = indexes[-1] #get last index
-            apply_annotations(label,s_ind, e_ind, df_ann) #concatenate dataframe of annotations
-            get_next_graph(e_ind, newECG)
+            s_ind, e_ind = session.window.rows_between(start_dt, end_dt) #first and last row (absolute) in the selection
+            session.log.annotator = txt_annotator.value
+            apply_annotations(label,s_ind, e_ind, session.log) #written to the log before moving on
+            get_next_graph(e_ind, session.window)
         except IndexError:
             txt_processing.text = 'Indexing error. Advance slider.'
 
-    ''' Function to apply annotations to a dataframe structured like that of Computing in Cardiology AF algorithm.
+    ''' Function to apply annotations to a log compacted like the Computing in Cardiology AF algorithm output (see annotation_log.py).
         Parameters: label a string (AF, Normal, Noise, Other), s_ind the index of the start datetime,
-                    e_ind the index of the end datetime, df a pandas database to be appended to, columns= 'AF'
+                    e_ind the index of the end datetime, log an AnnotationLog to be appended to
         Return: Nothing '''
-    def apply_annotations(label, s_ind, e_ind, df):
-        #data frame structure like this
-        if label == 'AF':
-            df.loc[s_ind,0] = 'A'
-        elif label == 'Not AF':
-            df.loc[s_ind,0] = 'nAF'
-        elif label == 'Noise':
-            df.loc[s_ind,0] = '~'
-        elif label == 'Normal':
-            df.loc[s_ind, 0] = 'N'
-        elif label == 'Other':
-            df.loc[s_ind,0] = 'O'
-        elif label == 'No Signal':
-            df.loc[s_ind,0] = '-'
+    def apply_annotations(label, s_ind, e_ind, log):
+        codes = {'AF': 'A', 'Not AF': 'nAF', 'Noise': '~', 'Normal': 'N', 'Other': 'O', 'No Signal': '-'}
+        if label in codes:
+            log.append(s_ind, e_ind, codes[label])
 
     ''' Stream update to ColumnDataSource that the file has been annotated'''
     def mark_as_done(file_path):
@@ -326,81 +359,47 @@ def main():
         
         
     ''' Callback function for btn_save.
-        Utilizes the out_file global variable for the path.
-        Appends dataframe to output file. '''
+        Utilizes the session's out_file for the path.
+        Writes the compacted label log to the output file, then removes the log. '''
     def callback_save_annotations():
         print("*********************Saving Annotations")
         txt_processing.style = {"font-size": '1.2em','color': 'Red'}
-        print("Writting: ", out_file)
+        print("Writting: ", session.out_file)
         txt_processing.text = 'Saving Annotations...'
-        df_ann.to_hdf(out_file,key = 'AF',format='t')
-        print("success!")
         btn_save.disabled = True
         btn_lbl.disabled = True
-        mark_as_done(out_file)
-        nrows = df_ann.shape[0]
-        df_ann.drop(df_ann.index[:nrows], inplace=True) #clear dataframe for a new file to be loaded
+        run_in_background(doc, annotations_saved, save_annotations, session.log.to_frame(), session.out_file,
+                          pool=save_executor)
+
+    ''' Runs on the executor: write the annotations (df) to file_path. '''
+    def save_annotations(df, file_path):
+        with hdf_lock:
+            df.to_hdf(file_path,key = 'AF',format='t')
+        return file_path
+
+    def annotations_saved(file_path, error):
+        if error is not None:
+            txt_processing.text = 'Saving failed: %s' % error
+            btn_save.disabled = False
+            btn_lbl.disabled = False
+            return
+        print("success!")
+        mark_as_done(file_path)
+        session.log.remove() #saved, start a new log for a new file to be loaded
         btn_load_annotated_graph.disabled = False
         txt_processing.style = {"font-size": '1.2em','color': 'SteelBlue'}
         txt_processing.text = '''Done. Click 'Load Annotated Graph' to view annotations or to "File Management" to select new file to anntoate. You will need to reload this file to make changes.'''
 
-    ''' Load annotations from AF formatted hdf file. '''
-    def load_annotations(start,end,df,df_AF):
-        # Initialize empty dataframes
-        noise = pd.DataFrame()
-        normal = pd.DataFrame()
-        other = pd.DataFrame()
-        af = pd.DataFrame()
-        nosig = pd.DataFrame()
-        notAF = pd.DataFrame()
-        # Read annotations
-        for n in range(start,end):
-            df_temp = df.iloc[df_AF.index[n]:df_AF.index[n+1]]
-            df_temp.index = list(df_temp['date'])
-            df_temp.drop(columns='date')
-            value = df_AF.iloc[n, 0]
-            if value == '~':
-                noise = noise.append(df_temp)
-            elif value == 'N':
-                normal = normal.append(df_temp)
-            elif value == 'O':
-                other = other.append(df_temp)
-            elif value == 'A':
-                af = af.append(df_temp)
-            elif value == '-':
-                nosig = nosig.append(df_temp)
-            elif value == 'nAF':
-                notAF = notAF.append(df_temp)
-        #add the last labelled section (end+1) to end of df
-        df_temp = df.iloc[df_AF.index[end]:df.index[-1]]
-        df_temp.index = list(df_temp['date'])
-        df_temp.drop(columns='date')
-        value = df_AF.iloc[end, 0]
-        if value == '~':
-            noise = noise.append(df_temp)
-        elif value == 'N':
-            normal = normal.append(df_temp)
-        elif value == 'O':
-            other = other.append(df_temp)
-        elif value == 'A':
-            af = af.append(df_temp)
-        elif value == '-':
-            nosig = nosig.append(df_temp)
-        elif value == 'nAF':
-            notAF = notAF.append(df_temp)  
-        return noise, normal, other, af, nosig, notAF
-
-    ''' Create Bokeh figure from dataframes af, normal, other and noise. '''
-    def get_graph_annotated(noise, normal, other, af, nosig, notAF):
-        p = figure(plot_width=1400, plot_height=500,x_axis_type='datetime',
+    ''' Create Bokeh figure from a source with one column per label (see plot_data), a line for each label in df_AF. '''
+    def get_graph_annotated(source, df_AF):
+        p = figure(plot_width=plot_width, plot_height=500,x_axis_type='datetime',
                 tools=['box_zoom', 'wheel_zoom', 'pan','reset','crosshair'])
+        start, end = get_time(source)
+        p.x_range = Range1d(start=start, end=end)
         # plot color coded waves (if they exist)
-        if noise.empty is False: p.line(x='index', y='II', source=noise, color = 'blue',legend = 'Noise')
-        if normal.empty is False: p.line(x='index', y='II', source=normal, color = 'green',legend = 'Normal')
-        if other.empty is False: p.line(x='index', y='II', source=other, color = 'purple',legend = 'Other')
-        if af.empty is False: p.line(x='index',y='II',source=af, color='red',legend = 'AF')
-        if nosig.empty is False: p.line(x='index',y='II',source=nosig, color='black',legend = 'No Signal')
-        if notAF.empty is False: p.line(x='index',y='II',source=notAF, color='grey',legend = 'No Signal')
+        present = set(df_AF[0])
+        for lbl, name, colour in ANNOTATION_STYLES:
+            if lbl in present: p.line(x='index', y=lbl, source=source, color=colour, legend=name)
         dt_axis_format = ["%d-%m-%Y %H:%M"]
         wf_x_axis = DatetimeTickFormatter(
                 hours=dt_axis_format,
@@ -409,6 +408,7 @@ def main():
                 years=dt_axis_format,
         )
         p.xaxis.formatter = wf_x_axis
+        refine_on_range(p, source, df_AF)
         return p
 
     ############################## Assign Callbacks ##########################################
@@ -23,15 +23,14 @@ AF_ann_compare.py
         bokeh serve --show afib_annotator.py --port 5100
 
     TO DO:
-    1. Return non-overlapping ranges for each dataframe - or if there are any
-    2. determine what the set the 'end' variable as?? arbitrarilly large number or the actual end of the file?
+    1. pass the recording end (rows in Waveforms) as 'end' rather than relying on default_end
 
     FUNCTIONALITY:
     Currently only concerned with AF detection at same points
     1. Get where AF is annotated in both dataframes (df1 = gold standard, df2 = what were comparing too - machine?)
-    2. Format as range()
-    3. Get intersection from the ranges
-    4. Return [[df1range, df2range], etc..] for all overlapping AF labelled segments
+    2. Format as (start, end) intervals
+    3. Find the overlapping pairs with a sorted sweep (interval_overlaps)
+    4. Return [[df1range, df2range], etc..] for all overlapping AF labelled segments, and the unmatched ones
 
 '''
 
@@ -58,47 +57,131 @@ return yes if AF is detected in both cases
 #             lst.append((inds[i],'end'))
 #     return lst
  
-def get_AF_indicies(df,str_lbl):
-    lstaf = []
-    inds = list(df.index)
-    for i in range(len(inds)):
-        index = inds[i]
-        if df[0].iloc[i] == str_lbl and i < len(inds)-1:
-            lstaf.append((index,inds[i+1]))
-        elif df[0].iloc[i] == str_lbl and i == len(inds)-1:
-            lstaf.append((index,1000000)) #arbitary number??
-    return lstaf
-
-def comp_AF_ann(df1,df2,str_lbl):
-    lstAFoverlap = []
-    lst1af = get_AF_indicies(df1,str_lbl)
-    lst2af = get_AF_indicies(df2,str_lbl)
-    lstAF1not = lst1af
-    lstAF2not = lst2af
-    for tpl1 in lst1af:
-        rng1 = range(tpl1[0], tpl1[1])
-        for tpl2 in lst2af:
-            rng2 = range(tpl2[0], tpl2[1])
-            set1 = set(rng1)
-            intersec = set1.intersection(rng2)
-            if bool(intersec):
-                lstAFoverlap.append([(rng1[0],rng1[-1]),(rng2[0],rng2[-1])])
-                #if tuple is matched then remove from not matched list
-                if tpl1 in lstAF1not:
-                    lstAF1not.remove(tpl1)
-                if tpl2 in lstAF2not:
-                    lstAF2not.remove(tpl2)
+# Run length encoding of the labels in 'column' of df (index = start row of each label, as in the AF key written by
+# afib_peak_detector.AF, one row per 30 s, or by the annotator). Consecutive rows with the same label are merged
+# into one run, which lasts to the start of the next run; the last one runs to 'end' (the end of the
+# recording, default one 30 s segment past the last row).
+# Returns (starts, ends, labels) arrays of the runs in time order
+def label_runs(df,end=None,column=0,len_seg=7200):
+    labels = df[column].to_numpy()
+    index = df.index.to_numpy(dtype=np.int64)
+    if len(labels) == 0:
+        return index, index, labels
+    end = int(index[-1]) + len_seg if end is None else end
+    change = np.empty(len(labels), dtype=bool)
+    change[0] = True
+    np.not_equal(labels[1:], labels[:-1], out=change[1:])
+    starts = index[change]
+    return starts, np.append(starts[1:], end), labels[change]
+
+# Episodes of every label in df (see label_runs), in one pass over the column
+# Returns {label: (start array, end array)}
+def get_episodes(df,end=None,column=0,len_seg=7200):
+    starts, ends, lbls = label_runs(df, end, column, len_seg)
+    if len(lbls) == 0:
+        return {}
+    order = np.argsort(lbls, kind='stable')
+    lbls, starts, ends = lbls[order], starts[order], ends[order]
+    bounds = np.flatnonzero(np.concatenate([[True], lbls[1:] != lbls[:-1], [True]]))
+    return {lbls[a]: (starts[a:b], ends[a:b]) for a, b in zip(bounds[:-1], bounds[1:])}
+
+# (start, end) tuples of the episodes labelled str_lbl (see get_episodes); the last one runs to 'end'
+# (the end of the recording, see default_end and compare_episodes)
+def get_AF_indicies(df,str_lbl,end):
+    starts, ends = get_episodes(df, end).get(str_lbl, ([], []))
+    return list(zip(np.asarray(starts).tolist(), np.asarray(ends).tolist()))
+
+# Sweep over two lists of sorted, non-overlapping half open intervals [start, end).
+# For every interval of list 1 the intervals of list 2 it overlaps are the run from the first one ending after
+# its start to the last one starting before its end, found by binary search, so the cost is O((n+m) log(n+m))
+# plus the number of overlaps.
+# Returns (i1, i2, duration): indexes into list 1 and list 2 of each overlapping pair and the length of the overlap
+def interval_overlaps(starts1, ends1, starts2, ends2):
+    starts1, ends1, starts2, ends2 = (np.asarray(a, dtype=np.int64) for a in (starts1, ends1, starts2, ends2))
+    first = np.searchsorted(ends2, starts1, 'right')
+    last = np.searchsorted(starts2, ends1, 'left')
+    counts = np.maximum(last-first, 0)
+    i1 = np.repeat(np.arange(len(starts1)), counts)
+    i2 = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts) + np.repeat(first, counts)
+    duration = np.minimum(ends1[i1], ends2[i2]) - np.maximum(starts1[i1], starts2[i2])
+    return i1, i2, duration
+
+# End of the recording for comparing df1 and df2 when it is not known: one 30 s segment (7200 rows at 240 Hz,
+# the AF output step) past the last label of either
+def default_end(df1, df2, len_seg=7200):
+    return int(max(df1.index[-1], df2.index[-1])) + len_seg
+
+# Episodes labelled str_lbl in df1 (gold standard) and df2 (compared to, e.g. the machine) as DataFrames with
+# 'start' and 'end' columns, plus their overlaps (rows 'ep1' and 'ep2' of those, 'start', 'end' and 'duration').
+# 'end' is the end of the recording (the end of the last episodes), see default_end when not given.
+# With the recording's time_index (waveform_store.TimeIndex) the end defaults to its rows and each frame also
+# gets the timestamps of its first and last rows ('start_time', 'end_time')
+def compare_episodes(df1,df2,str_lbl,end=None,time_index=None):
+    if end is None:
+        end = default_end(df1, df2) if time_index is None else time_index.nrows
+    ep1 = pd.DataFrame(get_AF_indicies(df1,str_lbl,end), columns=['start','end'], dtype=np.int64)
+    ep2 = pd.DataFrame(get_AF_indicies(df2,str_lbl,end), columns=['start','end'], dtype=np.int64)
+    i1, i2, duration = interval_overlaps(ep1['start'], ep1['end'], ep2['start'], ep2['end'])
+    overlaps = pd.DataFrame({'ep1': i1, 'ep2': i2,
+                             'start': np.maximum(ep1['start'].values[i1], ep2['start'].values[i2]),
+                             'end': np.minimum(ep1['end'].values[i1], ep2['end'].values[i2]),
+                             'duration': duration})
+    if time_index is not None:
+        for frame in (ep1, ep2, overlaps):
+            frame['start_time'] = time_index.time_of(frame['start'].values)
+            frame['end_time'] = time_index.time_of(frame['end'].values-1)
+    return ep1, ep2, overlaps
+
+LABELS = ['N', 'A', 'O', '~', '-', 'nAF'] # machine labels, no signal, and the annotator's not AF
+
+# Duration weighted confusion matrix of df1 (rows, gold standard) against df2 (columns): entry [i, j] is the
+# number of rows from 0 to 'end' labelled labels[i] in df1 and labels[j] in df2. Rows before the first label
+# of either, or with a label not in 'labels', are not counted
+def confusion_durations(df1,df2,end=None,labels=LABELS):
+    end = default_end(df1, df2) if end is None else end
+    codes = {lbl: i for i, lbl in enumerate(labels)}
+    matrix = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    runs1, runs2 = label_runs(df1, end), label_runs(df2, end)
+    if len(runs1[0]) == 0 or len(runs2[0]) == 0:
+        return matrix
+    bounds = np.union1d(runs1[0], runs2[0])
+    bounds = np.append(bounds[bounds < end], end)
+    codes1 = np.array([codes.get(lbl, -1) for lbl in runs1[2]])[np.searchsorted(runs1[0], bounds[:-1], 'right')-1]
+    codes2 = np.array([codes.get(lbl, -1) for lbl in runs2[2]])[np.searchsorted(runs2[0], bounds[:-1], 'right')-1]
+    ok = (bounds[:-1] >= max(runs1[0][0], runs2[0][0])) & (codes1 >= 0) & (codes2 >= 0)
+    np.add.at(matrix, (codes1[ok], codes2[ok]), np.diff(bounds)[ok])
+    return matrix
+
+# Cohen's kappa of a confusion matrix (counts or durations)
+def cohen_kappa(matrix):
+    matrix = np.asarray(matrix, dtype=float)
+    total = matrix.sum()
+    if total == 0:
+        return float('nan')
+    p_observed = np.trace(matrix)/total
+    p_expected = (matrix.sum(axis=0)*matrix.sum(axis=1)).sum()/total**2
+    return float((p_observed-p_expected)/(1-p_expected)) if p_expected < 1 else 1.0
+
+# Returns the overlapping episodes [[(start1, last row1), (start2, last row2)], ...] and the episodes
+# (start, end) of df1 and of df2 that overlap nothing in the other. 'end' and time_index are as for compare_episodes
+# (give one of them so an episode still open at the last label runs to the end of the recording)
+def comp_AF_ann(df1,df2,str_lbl,end=None,time_index=None):
+    ep1, ep2, overlaps = compare_episodes(df1,df2,str_lbl,end,time_index)
+    lstAFoverlap = [[(int(ep1.start[a]),int(ep1.end[a])-1),(int(ep2.start[b]),int(ep2.end[b])-1)] for a, b in zip(overlaps.ep1, overlaps.ep2)]
+    lstAF1not = list(ep1[~ep1.index.isin(overlaps.ep1)].itertuples(index=False, name=None))
+    lstAF2not = list(ep2[~ep2.index.isin(overlaps.ep2)].itertuples(index=False, name=None))
     return lstAFoverlap, lstAF1not, lstAF2not
 
 
-''' ********************** SAMPLE DATA *********************** '''
-df1 = pd.DataFrame(['N','~','A','N','A','O','A'],columns=[0],index=[0,100,150,300,450,500,560])
-df2 = pd.DataFrame(['N','~','A','N','A','O'],columns=[0],index=[0,80,170,290,460,500])
-comp_AF_ann(df1,df2,'A')
+if __name__ == '__main__':
+    ''' ********************** SAMPLE DATA *********************** '''
+    df1 = pd.DataFrame(['N','~','A','N','A','O','A'],columns=[0],index=[0,100,150,300,450,500,560])
+    df2 = pd.DataFrame(['N','~','A','N','A','O'],columns=[0],index=[0,80,170,290,460,500])
+    comp_AF_ann(df1,df2,'A')
 
-''' ********************** REAL AF DATA ********************** '''
-af2_path = '/mnt/data04/Conduit/afib/testAFAnn1.hdf'
-af1_path = '/mnt/data04/Conduit/afib/testAFAnn2.hdf'
-df1 = pd.read_hdf(af1_path)
-df2 = pd.read_hdf(af2_path)
-comp_AF_ann(df1,df2,'A')
+    ''' ********************** REAL AF DATA ********************** '''
+    af2_path = '/mnt/data04/Conduit/afib/testAFAnn1.hdf'
+    af1_path = '/mnt/data04/Conduit/afib/testAFAnn2.hdf'
+    df1 = pd.read_hdf(af1_path)
+    df2 = pd.read_hdf(af2_path)
+    comp_AF_ann(df1,df2,'A')
@@ -3,6 +3,10 @@
 """
 Created on Tue Jun 26 21:40:00 2018
 AF detection algorithm
+    Engines:
+        'matlab':           challengeKGH (below) run through the MATLAB engine for python
+        'native':           RR interval irregularity classifier written in NumPy, no MATLAB needed
+
     Major Dependencies:
         WFDB (MATLAB):      physionet package for viewing, analyzing, and creating recordings of physiologic signals
         shreyasi-datta-209: Code from 2017 computing in cardiology challenge 2017. https://physionet.org/challenge/2017/sources/shreyasi-datta-209.zip
@@ -27,59 +31,645 @@ AF detection algorithm
 
 import pandas as pd
 import numpy as np
-import matlab.engine
+try:
+    import matlab.engine
+except ImportError: # MATLAB is only needed for the 'matlab' engine
+    matlab = None
+try:
+    import scipy.signal
+    import scipy.ndimage
+except ImportError: # SciPy is only needed for NativeEngine.detect_waves
+    scipy = None
 
-from bokeh.models import PointDrawTool
+import time
+import queue
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
 
-from bokeh.plotting import figure 
-from bokeh.io import show, curdoc
-from bokeh.layouts import column, row, layout
-from bokeh.models import ColumnDataSource, Paragraph
+from waveform_store import open_waveforms, TimeIndex
+
+# Number of rows in the 'key' table at 'path'
+def get_nrows(path, key='Waveforms'):
+    with open_waveforms(path, key) as wf:
+        return wf.nrows
+
+# Timestamps and values of 'column' for rows start to stop of an open reader (waveform_store.open_waveforms),
+# NaNs replaced by 'fillna' when given
+def _read_rows(wf, column, start, stop, fillna=None):
+    times, values = wf.read(start, stop, column)
+    values = np.asarray(values, dtype=np.float64)
+    if fillna is not None:
+        values = np.where(np.isnan(values), fillna, values)
+    return times, values
+
+# Yields (start row, timestamps, values) for consecutive blocks of 'chunk_rows' rows of 'column' in the 'key' table
+# at 'path' (or its parquet cache, see waveform_store), opening the file once. Only rows start to stop
+# (default: to the end) are read. NaNs are replaced by 'fillna' when given.
+def iter_blocks(path, chunk_rows, key='Waveforms', column='II', fillna=None, start=0, stop=None):
+    with open_waveforms(path, key) as wf:
+        stop = wf.nrows if stop is None else min(stop, wf.nrows)
+        for chunk_start in range(start, stop, chunk_rows):
+            times, values = _read_rows(wf, column, chunk_start, min(chunk_start+chunk_rows, stop), fillna)
+            yield chunk_start, times, values
+
+# Yields (start row, core start, core stop, timestamps, values) for consecutive blocks of 'block_size' rows, each
+# extended by up to 'margin' rows of the neighbouring blocks on both sides. The block itself is
+# timestamps[core start:core stop]; detections in the margins should be dropped, so that beats across block edges
+# are found whole in one block and only kept in that one. Reads 'chunk_blocks' blocks (plus margins) at a time.
+def iter_windows(path, block_size, margin, chunk_blocks=86, key='Waveforms', column='II', fillna=None):
+    chunk_rows = block_size*chunk_blocks
+    with open_waveforms(path, key) as wf:
+        nrows = wf.nrows
+        for chunk_start in range(0, nrows, chunk_rows):
+            chunk_stop = min(chunk_start+chunk_rows, nrows)
+            read_start = max(chunk_start-margin, 0)
+            times, values = _read_rows(wf, column, read_start, min(chunk_stop+margin, nrows), fillna)
+            for s in range(chunk_start, chunk_stop, block_size):
+                lo = max(s-margin, read_start)-read_start
+                hi = min(s+block_size+margin, read_start+len(values))-read_start
+                core = s-read_start-lo
+                yield s, core, core+min(block_size, chunk_stop-s), times[lo:hi], values[lo:hi]
+
+# Keeps the hdf store at 'outfile' open and appends rows to its tables from preallocated NumPy buffers.
+# Rows are written once a key has 'buffer_rows' rows waiting or 'flush_seconds' have passed since the last write,
+# and the table indexes are only built on close() (index=False on every append). Used as a context manager the
+# store is flushed and closed on errors too, without building the indexes.
+#   with HDFWriter(outfile) as out:
+#       out.append('AF', index_array, {0: label_array})
+class HDFWriter:
+    def __init__(self, outfile, buffer_rows=100000, flush_seconds=60):
+        self.store = pd.HDFStore(outfile, mode='a')
+        self.buffer_rows = buffer_rows
+        self.flush_seconds = flush_seconds
+        self.buffers = {} # key -> [index array, {column: array}, rows used]
+        self.last_flush = time.time()
+
+    def append(self, key, index, columns):
+        n = len(index)
+        if key not in self.buffers:
+            size = max(self.buffer_rows, n)
+            self.buffers[key] = [np.empty(size, np.asarray(index).dtype),
+                                {name: np.empty(size, np.asarray(values).dtype) for name, values in columns.items()}, 0]
+        buf = self.buffers[key]
+        if buf[2]+n > len(buf[0]):
+            self.flush(key)
+        if n > len(buf[0]): # larger than the buffer, write straight away
+            self._write(key, index, columns)
+        else:
+            buf[0][buf[2]:buf[2]+n] = index
+            for name, values in columns.items():
+                buf[1][name][buf[2]:buf[2]+n] = values
+            buf[2] += n
+        if buf[2] >= self.buffer_rows or time.time()-self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def _write(self, key, index, columns):
+        self.store.append(key, pd.DataFrame(columns, index=index), format='t', index=False)
+
+    # Writes the rows waiting for 'key' (default: every key)
+    def flush(self, key=None):
+        for k in ([key] if key is not None else list(self.buffers)):
+            index, columns, n = self.buffers[k]
+            if n:
+                self._write(k, index[:n], {name: values[:n] for name, values in columns.items()})
+                self.buffers[k][2] = 0
+        self.last_flush = time.time()
+
+    def close(self, index=True):
+        try:
+            self.flush()
+            if index:
+                for key in self.buffers:
+                    if key in self.store: # keys only ever given empty arrays have no table
+                        self.store.create_table_index(key, optlevel=6, kind='medium')
+        finally:
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(index=exc_type is None)
+
+
+############################## Classifier engines ##############################
+# An engine classifies one segment of ECG into N=normal, A=AF, O=other rhythm, ~=noise
+# through classify(ecg, fs), or a 2D array of equal length segments (one per row) through
+# classify_batch(segments, fs), and is released with close(). '-' (no signal) is decided in classify_segments().
+# Engines used by rPeaks() also find R, P and T waves with detect_waves(times, ecg, fs).
+# ping() returns True while the engine is usable (see EnginePool).
+
+class MatlabEngine:
+    ''' Computing in Cardiology 2017 challenge code (challengeKGH) and ecgpuwave_wrapper run through the MATLAB engine '''
+    def __init__(self, code_paths=('/mnt/data04/Conduit/afib/challengeCode', '/mnt/data04/Conduit/afib/mcode')):
+        print('Starting Matlab engine')
+        self.eng = matlab.engine.start_matlab()
+        for code_path in code_paths:
+            self.eng.addpath(code_path)
+
+    def ping(self):
+        self.eng.eval('1;', nargout=0)
+        return True
+
+    def detect_waves(self, times, ecg, fs):
+        ann, anntype = self.eng.ecgpuwave_wrapper(times.astype(np.int64).tolist(),(ecg*1000).tolist(),'test',fs,nargout=2)
+        ann = np.asarray(ann, dtype=np.int64).reshape(-1)
+        anntype = np.array(list(anntype)) # a 1xN char array comes back as a str, one character per annotation
+        return ann[anntype == 'N'], ann[anntype == 'p'], ann[anntype == 't']
+
+    def classify(self, ecg, fs):
+        return self.eng.challengeKGH(ecg.tolist(), fs, nargout=1)
+
+    def classify_batch(self, segments, fs):
+        return np.array([self.classify(ecg, fs) for ecg in segments], dtype='<U1')
+
+    def close(self):
+        self.eng.quit()
+
+
+class NativeEngine:
+    ''' AF detection from RR interval irregularity, in NumPy. R, P and T waves for rPeaks() are found
+        with detect_rpt (SciPy).
+        QRS complexes are found with a Pan-Tompkins style filter (baseline removal, smoothing, derivative,
+        squaring, moving window integration) and a refractory period, then the RR series is scored:
+            ~   no clear QRS complexes, too few beats, or RR intervals outside physiological limits
+            A   most successive RR differences are large and the normalised RMSSD is high
+            O   irregular from a few ectopic beats, or rate outside 50-100 bpm
+            N   otherwise '''
+    min_beats = 5           # fewer beats than this in a segment is noise
+    min_snr = 4             # QRS to background energy ratio (see qrs_detect) below this is noise
+    rr_limits = (0.25, 2.0) # physiological RR interval limits in seconds (240 to 30 bpm)
+    hr_limits = (50, 100)   # normal heart rate in bpm
+    irregular_diff = 0.15   # successive RR difference, relative to the median RR, counted as irregular
+    af_irregular = 0.45     # fraction of irregular RR differences needed for AF
+    af_nrmssd = 0.1         # RMSSD/mean RR needed for AF (or for ectopy when irregular fraction is low)
+
+    def classify(self, ecg, fs):
+        return str(self.classify_batch(ecg[np.newaxis], fs)[0])
+
+    # All segments are scored at once: the beats of every row are taken from one np.nonzero over the
+    # QRS mask and the per segment RR statistics are grouped by row with bincount/lexsort
+    def classify_batch(self, segments, fs):
+        n = segments.shape[0]
+        mask, snr = qrs_detect(segments, fs)
+        rows, cols = np.nonzero(mask)
+        n_beats = np.bincount(rows, minlength=n)
+        # RR intervals within each row
+        same = rows[1:] == rows[:-1]
+        rr = (np.diff(cols)/fs)[same]
+        rr_rows = rows[1:][same]
+        n_rr = np.bincount(rr_rows, minlength=n)
+        has_rr = n_rr > 0
+        rr_min = np.full(n, np.inf)
+        rr_max = np.full(n, -np.inf)
+        np.minimum.at(rr_min, rr_rows, rr)
+        np.maximum.at(rr_max, rr_rows, rr)
+        rr_mean = np.bincount(rr_rows, rr, minlength=n)/np.maximum(n_rr, 1)
+        # median RR of each row from the row-major sorted intervals
+        rr_sorted = rr[np.lexsort((rr, rr_rows))]
+        first = np.concatenate([[0], np.cumsum(n_rr)[:-1]])
+        lo = np.minimum(first+(n_rr-1)//2, max(len(rr)-1, 0))
+        hi = np.minimum(first+n_rr//2, max(len(rr)-1, 0))
+        rr_median = np.where(has_rr, (rr_sorted[lo]+rr_sorted[hi])/2 if len(rr) else 0, np.nan)
+        # successive RR differences within each row
+        same = rr_rows[1:] == rr_rows[:-1]
+        drr = np.abs(np.diff(rr))[same]
+        drr_rows = rr_rows[1:][same]
+        n_drr = np.maximum(np.bincount(drr_rows, minlength=n), 1)
+        nrmssd = np.sqrt(np.bincount(drr_rows, drr**2, minlength=n)/n_drr)/np.where(has_rr, rr_mean, 1)
+        irregular = np.bincount(drr_rows, drr > self.irregular_diff*rr_median[drr_rows], minlength=n)/n_drr
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hr = 60/rr_median
+            noise = ((snr < self.min_snr) | (n_beats < self.min_beats)
+                    | (rr_min < self.rr_limits[0]/2) | (rr_max > self.rr_limits[1]*2)
+                    | ~((rr_median >= self.rr_limits[0]) & (rr_median <= self.rr_limits[1])))
+        af = (irregular >= self.af_irregular) & (nrmssd >= self.af_nrmssd)
+        other = (nrmssd >= self.af_nrmssd) | ~((hr >= self.hr_limits[0]) & (hr <= self.hr_limits[1]))
+        return np.select([noise, af, other], ['~', 'A', 'O'], 'N')
+
+    def detect_waves(self, times, ecg, fs):
+        return detect_rpt(ecg, fs)
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+
+ENGINES = {'matlab': MatlabEngine, 'native': NativeEngine}
+
+def get_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine ' + str(engine) + ', use one of ' + str(list(ENGINES)))
+    if engine == 'matlab' and matlab is None:
+        raise ImportError('matlab.engine is not installed, use the native engine')
+    return ENGINES[engine]()
+
+
+class EnginePool:
+    ''' Started engines kept for reuse across files and across the AF and R peak stages, e.g.
+            with EnginePool('matlab', size=2) as pool:
+                for case in cases:
+                    AF(in_path+case, af_path+case, pool)
+                    rPeaks(in_path+case, peaks_path+case, pool)
+        engine is an engine name (see ENGINES) or a function returning a new engine, such as a local stand-in.
+        An engine is health checked (ping) when it is checked out and after an error while in use,
+        and is restarted if it has died. '''
+    def __init__(self, engine='matlab', size=1):
+        self.factory = (lambda: get_engine(engine)) if isinstance(engine, str) else engine
+        self.restarts = 0 # number of engines restarted so far
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self.factory())
+        self.size = size
+
+    def _alive(self, eng):
+        try:
+            return bool(eng.ping())
+        except Exception:
+            return False
+
+    def _restart(self, eng):
+        print('Restarting engine')
+        try:
+            eng.close()
+        except Exception:
+            pass
+        eng = self.factory()
+        self.restarts += 1
+        return eng
+
+    # Checks out an idle engine (waiting for one if all are in use) and returns it to the pool afterwards
+    @contextmanager
+    def acquire(self):
+        eng = self._idle.get()
+        try:
+            if not self._alive(eng):
+                eng = self._restart(eng)
+            yield eng
+        except BaseException:
+            if not self._alive(eng):
+                eng = self._restart(eng)
+            raise
+        finally:
+            self._idle.put(eng)
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Engine to use for 'engine' as passed to AF() or rPeaks(): a name starts an engine that is closed afterwards,
+# an EnginePool lends one of its engines and anything else is taken as an already started engine
+@contextmanager
+def engine_context(engine):
+    if isinstance(engine, str):
+        eng = get_engine(engine)
+        try:
+            yield eng
+        finally:
+            eng.close()
+    elif isinstance(engine, EnginePool):
+        with engine.acquire() as eng:
+            yield eng
+    else:
+        yield engine
+
+
+############################## QRS detection ##############################
+# These work along the last axis so a single segment or a stack of segments can be passed.
+
+# Centred moving average of n samples, shrinking the window at the edges
+def moving_average(x, n):
+    L = x.shape[-1]
+    c = np.concatenate([np.zeros(x.shape[:-1]+(1,)), np.cumsum(x, axis=-1)], axis=-1)
+    lo = np.clip(np.arange(L)-n//2, 0, L)
+    hi = np.clip(np.arange(L)-n//2+n, 0, L)
+    return (c[..., hi]-c[..., lo])/(hi-lo)
+
+# Maximum over x[i-w:i+w+1] for every i (van Herk/Gil-Werman, O(L) whatever w is)
+def running_max(x, w):
+    k = 2*w+1
+    L = x.shape[-1]
+    n = -(-(L+2*w)//k)*k
+    y = np.full(x.shape[:-1]+(n,), -np.inf)
+    y[..., w:w+L] = x
+    blocks = y.reshape(x.shape[:-1]+(n//k, k))
+    g = np.maximum.accumulate(blocks, axis=-1).reshape(y.shape)
+    h = np.maximum.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(y.shape)
+    return np.maximum(h[..., :L], g[..., k-1:k-1+L])
+
+# Finds QRS complexes: maxima of the integrated signal, at least 'refractory' seconds apart and above
+# 'threshold' times its 98th percentile, moved to the largest deflection of the filtered ECG within 75 ms.
+# Returns a boolean mask of R peak locations and the ratio of the 98th percentile to the median of the
+# integrated signal (high for clean ECG, close to 1 for noise)
+def qrs_detect(ecg, fs, refractory=0.2, threshold=0.3):
+    x = ecg - moving_average(ecg, int(0.2*fs)) # remove baseline wander
+    x = moving_average(x, max(int(0.02*fs), 1)) # smooth high frequency noise
+    d = np.diff(x, axis=-1, prepend=x[..., :1])
+    integ = moving_average(d**2, int(0.15*fs))
+    p98 = np.percentile(integ, 98, axis=-1, keepdims=True)
+    rising = np.concatenate([np.zeros(integ.shape[:-1]+(1,), bool), integ[..., 1:] > integ[..., :-1]], axis=-1)
+    found = (integ == running_max(integ, int(refractory*fs))) & (integ > threshold*p98) & rising
+    # refine to the R peak
+    L = ecg.shape[-1]
+    w = int(0.075*fs)
+    rows, cols = np.nonzero(found.reshape(-1, L))
+    windows = np.clip(cols[:, None]+np.arange(-w, w+1), 0, L-1)
+    cols = windows[np.arange(len(cols)), np.abs(x.reshape(-1, L)[rows[:, None], windows]).argmax(axis=1)]
+    mask = np.zeros((found.size//L, L), bool)
+    mask[rows, cols] = True
+    snr = p98[..., 0]/np.maximum(np.median(integ, axis=-1), np.finfo(float).tiny)
+    return mask.reshape(found.shape), snr
+
+
+# Labels of the rows of 'segments' (n_segments, rows per segment): segments with NaNs or values at or below dis_value
+# (disconnected) are labelled '-' and the rest go to eng.classify_batch in one call, NaNs replaced by nan_value.
+def classify_matrix(segments, fs, eng, dis_value=-79, nan_value=-128):
+    labels = np.full(len(segments), '-', dtype='<U1')
+    nans = np.isnan(segments)
+    disconnected = nans.any(axis=1) | (segments.min(axis=1, initial=np.inf, where=~nans) <= dis_value)
+    if not disconnected.all():
+        segments = np.where(nans, nan_value, segments)
+        labels[~disconnected] = eng.classify_batch(segments[~disconnected], fs)
+    return labels
+
+# Classifies consecutive len_seg segments of 'values' (one block of lead II) with 'eng' in one call.
+# The block is reshaped to (n_segments, len_seg) (see classify_matrix).
+# A shorter last segment is classified on its own. Returns an array of labels, one per segment.
+def classify_segments(values, len_seg, fs, eng, dis_value=-79, nan_value=-128):
+    n_full = len(values)//len_seg
+    labels = np.full(-(-len(values)//len_seg), '-', dtype='<U1')
+    for first, segments in ((0, values[:n_full*len_seg].reshape(n_full, len_seg)), (n_full, values[n_full*len_seg:][np.newaxis])):
+        if segments.size:
+            labels[first:first+len(segments)] = classify_matrix(segments, fs, eng, dis_value, nan_value)
+    return labels
+
+# Segments of n_seconds of the recording described by time_index (waveform_store.TimeIndex, built from its
+# timestamps). Each run of regularly sampled rows is cut at its own sampling rate into segments starting every
+# n_seconds from the start of the run, so no segment spans a gap or a change of rate; the last segment of a run
+# is shorter. Returns the first row, number of rows, start time (datetime64[ns]) and sampling rate (Hz, rounded)
+# of each segment.
+def time_segments(time_index, n_seconds=30):
+    lengths = np.diff(np.append(time_index.starts, time_index.nrows))
+    rate = np.divide(1e9, time_index.period, out=np.ones_like(time_index.period), where=time_index.period > 0)
+    fs = np.maximum(np.round(rate), 1).astype(np.int64)
+    seg_rows = np.maximum(np.round(n_seconds*rate), 1).astype(np.int64)
+    n_seg = -(-lengths//seg_rows)
+    run = np.repeat(np.arange(len(lengths)), n_seg)
+    k = np.arange(len(run)) - np.repeat(np.cumsum(n_seg)-n_seg, n_seg)
+    starts = time_index.starts[run] + k*seg_rows[run]
+    rows = np.minimum(seg_rows[run], time_index.starts[run]+lengths[run]-starts)
+    return starts, rows, time_index.time_of(starts), fs[run]
+
+# Classifies the segments of 'values' starting at 'offsets' with 'lengths' rows sampled at 'fs' (arrays, see
+# time_segments). Segments shorter than min_seconds (the end of a run before a gap) are labelled '-' without
+# being classified; the others are classified in one call per length and rate (see classify_matrix).
+def classify_time_segments(values, offsets, lengths, fs, eng, min_seconds=10, dis_value=-79, nan_value=-128):
+    labels = np.full(len(offsets), '-', dtype='<U1')
+    usable = lengths >= min_seconds*fs
+    for length, rate in np.unique(np.stack([lengths[usable], fs[usable]], axis=1), axis=0):
+        sel = np.flatnonzero(usable & (lengths == length) & (fs == rate))
+        segments = values[offsets[sel, np.newaxis]+np.arange(length)]
+        labels[sel] = classify_matrix(segments, int(rate), eng, dis_value, nan_value)
+    return labels
+
+
+############################## R, P and T waves ##############################
+
+# Largest value of sig in the window start+offsets[0] to start+offsets[-1] around each start, limited to
+# before 'limit' when given. Returns the index of that value for each start
+def _argmax_windows(sig, starts, offsets, limit=None):
+    ind = starts[:, np.newaxis]+offsets
+    valid = (ind >= 0) & (ind < len(sig))
+    if limit is not None:
+        valid &= ind < limit[:, np.newaxis]
+    values = np.where(valid, sig[np.clip(ind, 0, len(sig)-1)], -np.inf)
+    best = values.argmax(axis=1)
+    found = np.isfinite(values[np.arange(len(starts)), best])
+    return ind[np.arange(len(starts)), best][found]
+
+# R, P and T wave sample indices of the ECG (1D array) as integer arrays.
+#   R   QRS complexes by Pan-Tompkins: 5-15 Hz band-pass, derivative, squaring and 150 ms moving window integration,
+#       peaks above an adaptive threshold ('threshold' times the largest integrated value in the last 'window'
+#       seconds, and at least the mean over 5 s) at least 'refractory' seconds apart, moved to the largest
+#       deflection of the band-passed ECG within 75 ms
+#   P   largest value of the 0.5-12 Hz ECG 250 to 80 ms before each R
+#   T   largest value of the 0.5-12 Hz ECG 120 to 450 ms after each R, before the next R
+# Disconnected (<= dis_value) and NaN samples are set to the median of the others before filtering, and no wave is
+# kept in them or within 'edge' seconds of them. Integrated values below min_energy are never a beat, so a flat
+# signal (filtered to rounding noise) gives none.
+def detect_rpt(ecg, fs, refractory=0.2, threshold=0.25, window=2, dis_value=-79, edge=0.5, min_energy=1e-7):
+    ecg = np.array(ecg, dtype=np.float64)
+    empty = np.array([], dtype=np.int64)
+    bad = np.isnan(ecg) | (ecg <= dis_value)
+    if len(ecg) < fs or bad.all():
+        return empty, empty, empty
+    ecg[bad] = np.median(ecg[~bad])
+    near_bad = scipy.ndimage.binary_dilation(bad, np.ones(2*int(edge*fs)+1, dtype=bool)) if bad.any() else bad
+    qrs = scipy.signal.sosfiltfilt(scipy.signal.butter(2, [5, 15], 'bandpass', fs=fs, output='sos'), ecg)
+    integ = scipy.ndimage.uniform_filter1d(np.gradient(qrs)**2, int(0.15*fs))
+    thr = np.maximum(threshold*scipy.ndimage.maximum_filter1d(integ, int(window*fs), origin=int(window*fs)//2-1),
+                     scipy.ndimage.uniform_filter1d(integ, int(5*fs)))
+    peaks, _ = scipy.signal.find_peaks(integ, height=np.maximum(thr, min_energy), distance=max(int(refractory*fs), 1))
+    R = np.unique(_argmax_windows(np.abs(qrs), peaks, np.arange(-int(0.075*fs), int(0.075*fs)+1)))
+    R = R[~near_bad[R]]
+    waves = scipy.signal.sosfiltfilt(scipy.signal.butter(2, [0.5, 12], 'bandpass', fs=fs, output='sos'), ecg)
+    P = _argmax_windows(waves, R, np.arange(-int(0.25*fs), -int(0.08*fs)+1))
+    T = _argmax_windows(waves, R, np.arange(int(0.12*fs), int(0.45*fs)+1), np.append(R[1:], len(ecg)))
+    P, T = P[~near_bad[P]], T[~near_bad[T]]
+    return R, P, T
+
+
+# Yields an array of labels for each block of chunk_segments segments of lead II in rows start to stop
+# (start should be a multiple of len_seg so segments line up with the rest of the file)
+def classify_blocks(path, eng, len_seg, fs, chunk_segments=120, dis_value=-79, nan_value=-128, start=0, stop=None):
+    for chunk_start, chunk_times, ECG in iter_blocks(path, len_seg*chunk_segments, start=start, stop=stop):
+        yield classify_segments(ECG, len_seg, fs, eng, dis_value, nan_value)
+
+# Yields an array of labels for each block of chunk_segments of the segments (first row, number of rows and rate
+# arrays from time_segments) of lead II, reading the rows they cover one block at a time
+def classify_time_blocks(path, eng, starts, rows, fs, chunk_segments=120, min_seconds=10, dis_value=-79, nan_value=-128):
+    with open_waveforms(path) as wf:
+        for i in range(0, len(starts), chunk_segments):
+            sl = slice(i, i+chunk_segments)
+            first, last = starts[sl][0], starts[sl][-1]+rows[sl][-1]
+            times, ECG = _read_rows(wf, 'II', first, last)
+            yield classify_time_segments(ECG, starts[sl]-first, rows[sl], fs[sl], eng, min_seconds, dis_value, nan_value)
+
+_worker_engine = None # engine of a worker process started by classify_parallel
+
+def _init_worker(engine):
+    global _worker_engine
+    _worker_engine = get_engine(engine)
+    Finalize(_worker_engine, _worker_engine.close, exitpriority=10)
+
+def _classify_range(path, start, stop, len_seg, fs, chunk_segments, dis_value, nan_value):
+    return np.concatenate(list(classify_blocks(path, _worker_engine, len_seg, fs, chunk_segments, dis_value, nan_value, start, stop)))
+
+def _classify_time_range(path, starts, rows, fs, chunk_segments, min_seconds, dis_value, nan_value):
+    return np.concatenate(list(classify_time_blocks(path, _worker_engine, starts, rows, fs, chunk_segments, min_seconds, dis_value, nan_value)))
+
+# Splits the waveforms at 'path' into disjoint row ranges of whole segments (about 4 per worker) and
+# classifies them in 'workers' processes, each with its own 'engine'. Yields the label arrays in file order.
+def classify_parallel(path, engine, workers, len_seg, fs, chunk_segments=120, dis_value=-79, nan_value=-128):
+    nrows = get_nrows(path)
+    n_segments = -(-nrows//len_seg)
+    range_rows = max(1, -(-n_segments//(workers*4)))*len_seg
+    starts = list(range(0, nrows, range_rows))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(engine,)) as ex:
+        futures = [ex.submit(_classify_range, path, start, start+range_rows, len_seg, fs, chunk_segments, dis_value, nan_value) for start in starts]
+        for future in futures:
+            yield future.result()
+
+LABEL_CODES = np.array(['N', 'A', 'O', '~', '-']) # labels as returned by the pipeline workers (uint8 codes)
+
+def encode_labels(labels):
+    codes = np.full(len(labels), 255, dtype=np.uint8)
+    for code, label in enumerate(LABEL_CODES):
+        codes[labels == label] = code
+    if (codes == 255).any():
+        raise ValueError('unknown labels ' + str(np.unique(labels[codes == 255])))
+    return codes
+
+# Reader process of classify_pipeline: decodes blocks of lead II into free slots of the ring and queues them
+def _pipeline_reader(path, chunk_rows, slots, free, work, n_workers):
+    try:
+        for chunk, (start, times, values) in enumerate(iter_blocks(path, chunk_rows)):
+            slot = free.get() # waits while every slot is being classified
+            np.ndarray(len(values), np.float64, buffer=slots[slot].buf)[:] = values
+            work.put((chunk, slot, len(values)))
+    finally:
+        for _ in range(n_workers):
+            work.put(None)
+
+# Classifier process of classify_pipeline: classifies the segments of a slot in place and returns label codes
+def _pipeline_worker(engine, slots, free, work, results, len_seg, fs, dis_value, nan_value):
+    eng = get_engine(engine)
+    try:
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            chunk, slot, n = item
+            try:
+                values = np.ndarray(n, np.float64, buffer=slots[slot].buf)
+                codes = encode_labels(classify_segments(values, len_seg, fs, eng, dis_value, nan_value))
+                del values
+                results.put((chunk, codes, None))
+            except Exception:
+                results.put((chunk, None, traceback.format_exc()))
+            finally:
+                free.put(slot)
+    finally:
+        eng.close()
+
+# As classify_parallel, with one reader process decoding the file in order into a ring of 'slots' shared memory
+# blocks of chunk_segments segments (default 2 per worker) and 'workers' processes classifying them in place.
+# Only slot numbers and uint8 label codes go through the queues, and the reader waits for a free slot, so at most
+# 'slots' blocks are in memory whatever the speed of the classifiers. Yields the label arrays in file order.
+def classify_pipeline(path, engine, workers, len_seg, fs, chunk_segments=120, dis_value=-79, nan_value=-128, slots=None):
+    chunk_rows = len_seg*chunk_segments
+    n_chunks = -(-get_nrows(path)//chunk_rows)
+    ring = [shared_memory.SharedMemory(create=True, size=chunk_rows*8) for _ in range(slots or 2*workers)]
+    free, work, results = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Queue()
+    for slot in range(len(ring)):
+        free.put(slot)
+    procs = [multiprocessing.Process(target=_pipeline_reader, args=(path, chunk_rows, ring, free, work, workers), daemon=True)]
+    procs += [multiprocessing.Process(target=_pipeline_worker, args=(engine, ring, free, work, results, len_seg, fs, dis_value, nan_value), daemon=True)
+              for _ in range(workers)]
+    try:
+        for proc in procs:
+            proc.start()
+        done = {}
+        for chunk in range(n_chunks):
+            while chunk not in done:
+                try:
+                    c, codes, error = results.get(timeout=5)
+                except queue.Empty:
+                    if any(proc.exitcode not in (None, 0) for proc in procs):
+                        raise RuntimeError('a pipeline process died')
+                    continue
+                if error is not None:
+                    raise RuntimeError('chunk %d failed:\n%s' % (c, error))
+                done[c] = codes
+            yield LABEL_CODES[done.pop(chunk)]
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        for shm in ring:
+            shm.close()
+            shm.unlink()
+
+# As classify_parallel for the segments of time_segments, split into about 4 ranges of segments per worker
+def classify_time_parallel(path, engine, workers, starts, rows, fs, chunk_segments=120, min_seconds=10, dis_value=-79, nan_value=-128):
+    n = max(1, -(-len(starts)//(workers*4)))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(engine,)) as ex:
+        futures = [ex.submit(_classify_time_range, path, starts[i:i+n], rows[i:i+n], fs[i:i+n], chunk_segments, min_seconds, dis_value, nan_value)
+                   for i in range(0, len(starts), n)]
+        for future in futures:
+            yield future.result()
 
-import time
 
-def AF(path,outfile):
-    # Start Matlab engine
-    print('Starting Matlab engine')
-    eng = matlab.engine.start_matlab();
-    eng.addpath('/mnt/data04/Conduit/afib/challengeCode');
+# Creates an AF key on the hdf file at 'outfile' classifying each 30 second segment of lead II of the waveforms at 'path'.
+# engine is 'matlab' (challenge code), 'native' (NumPy, see NativeEngine), an EnginePool or an already started engine
+# (engines from a pool or passed in are left open so they can be reused for other files).
+# With workers > 1 the file is split into row ranges classified in that many processes (engine must then be a name),
+# or with pipeline read by one process and classified by the others through shared memory (see classify_pipeline).
+# With time_aligned the segments are cut from the timestamps instead of every 7200 rows (see time_segments), so
+# none spans a gap or a change of sampling rate; segments shorter than min_seconds are labelled '-' unclassified,
+# and the AF key also has the start time ('time') and length in seconds ('seconds') of each segment.
+# Returns the number of segments classified, None if the file or its waveforms are missing.
+def AF(path,outfile,engine='matlab',chunk_segments=120,workers=1,time_aligned=False,min_seconds=10,pipeline=False):
+    if workers > 1 and not isinstance(engine, str):
+        raise ValueError('Pass the engine by name to classify with several workers')
     n_seconds = 30 # length of segments
     fs = 240 # sampling frequency
     dis_value = -79 # default value when disconnected for bedmaster ICU data
-    block_size = 100 # write to df every n blocks
     len_seg = n_seconds*fs # number of indices to select
     WFDBNAN = -128 #https://physionet.org/physiotools/matlab/wfdb-app-matlab/html/mat2wfdb.m 
 
-    results = [] # empty list to hold results
-    i = 0 # value to hold index location in hdf5 file
-    blocks = 0 # holds number of blocks written so far
-    time_start = time.time()
-    time_reset = time.time()
+    written = 0 # holds number of segments classified so far
     try: 
-        ECG = pd.read_hdf(path,key = 'Waveforms',start = len_seg*i,stop = len_seg*(i+1)-1).II
-        #print(blocks, ECG)
-        ECG = ECG.fillna(WFDBNAN)
-        #ECG = ECG_full.II
-        while(not ECG.empty):
-            print(len(results))
-            if min(ECG) <= dis_value: # if value has any non-existant values, list as '-'
-                results += '-'
+        with engine_context(None if workers > 1 else engine) as eng, HDFWriter(outfile) as out:
+            # chunk_segments segments (default 120 = 1 hour) are read from the file and classified at a time
+            if time_aligned:
+                time_index = TimeIndex.load(path) # the timestamps are read once, then cached next to the file
+                starts, rows, seg_times, seg_fs = time_segments(time_index, n_seconds)
+                print(len(time_index.starts)-1, "gaps or rate changes,", np.count_nonzero(rows < min_seconds*seg_fs), "short segments not classified")
+                if workers > 1:
+                    labels = classify_time_parallel(path, engine, workers, starts, rows, seg_fs, chunk_segments, min_seconds, dis_value, WFDBNAN)
+                else:
+                    labels = classify_time_blocks(path, eng, starts, rows, seg_fs, chunk_segments, min_seconds, dis_value, WFDBNAN)
+            elif workers > 1 and pipeline:
+                labels = classify_pipeline(path, engine, workers, len_seg, fs, chunk_segments, dis_value, WFDBNAN)
+            elif workers > 1:
+                labels = classify_parallel(path, engine, workers, len_seg, fs, chunk_segments, dis_value, WFDBNAN)
             else:
-                results += eng.challengeKGH(list(ECG),fs,nargout=1) # get classification
-            i += 1
-            time_finished_processing = time.time()
-            if len(results) >= block_size:
-                print('Sending to df')
-                pd.DataFrame(results, index = range(block_size*(blocks)*len_seg, block_size*(blocks+1)*len_seg, len_seg)).to_hdf(outfile,key = 'AF',append=True,format='t')
-                results = []
-                blocks += 1
-                time_block_done = time.time()
-                #print("*********************Finished sending to df:",time_block_done-time_reset)
-                timr_reset = time.time()
-            ECG = pd.read_hdf(path,key = 'Waveforms',start = len_seg*i,stop = len_seg*(i+1)-1).II
-            ECG = ECG.fillna(WFDBNAN)
-            #ECG = ECG_full.II
-        pd.DataFrame(results, index = range(block_size*(blocks)*len_seg, block_size*(blocks)*len_seg+len_seg*len(results), len_seg)).to_hdf(outfile,key = 'AF',append=True,format='t')
+                labels = classify_blocks(path, eng, len_seg, fs, chunk_segments, dis_value, WFDBNAN)
+            for block_labels in labels:
+                if time_aligned:
+                    sl = slice(written, written+len(block_labels))
+                    out.append('AF', starts[sl], {0: block_labels, 'time': seg_times[sl], 'seconds': rows[sl]/seg_fs[sl]})
+                else:
+                    out.append('AF', np.arange(written, written+len(block_labels))*len_seg, {0: block_labels})
+                written += len(block_labels)
+                print(written)
+        return written
     except FileNotFoundError:
         print('File at' + path + 'not found')
         return
@@ -88,32 +678,33 @@ def AF(path,outfile):
         return
     finally:
         print('All Done')
-        eng.quit()
 
 
 # Creates a R_peak key on the hdf file at 'outpath' using the waveforms key from the hdf file at 'path'
-def rPeaks(path,outpath):
-    print('Starting Matlab engine')
-    eng = matlab.engine.start_matlab();
-    eng.addpath('/mnt/data04/Conduit/afib/mcode');
-    block_size = 10000
-    i = 0
+# engine is as for AF() and must provide detect_waves (the MATLAB engine runs ecgpuwave_wrapper, the native
+# engine detect_rpt).
+# Waves are detected on blocks of block_size rows with 'margin' rows of the neighbouring blocks on each side,
+# and only those inside the block itself are kept (see iter_windows).
+# Returns the number of R peaks found, None if the file is missing.
+def rPeaks(path,outpath,engine='matlab',chunk_blocks=86,block_size=10000,margin=480):
+    n_peaks = 0
     try: 
-        store = pd.read_hdf(path, key = 'Waveforms',start = block_size*i,stop = block_size*(i+1)-1)
-        while(not store.empty):
-            ann, anntype = eng.ecgpuwave_wrapper(list(pd.to_numeric(store.index)),list(store.II*1000),'test',240,nargout=2)
-            Q = [int(ann[i][0]) for i, e in enumerate(anntype) if e == 'N']
-            P = [int(ann[i][0]) for i, e in enumerate(anntype) if e == 'p']
-            T = [int(ann[i][0]) for i, e in enumerate(anntype) if e == 't']
-            pd.DataFrame({'Position':store.iloc[Q,:].index, 'Value':store.iloc[Q,:].II}).to_hdf(outpath, 'R_Peaks', append = True, format = 't')
-            pd.DataFrame({'Position':store.iloc[P,:].index, 'Value':store.iloc[P,:].II}).to_hdf(outpath, 'P_Peaks', append = True, format = 't')
-            pd.DataFrame({'Position':store.iloc[T,:].index, 'Value':store.iloc[T,:].II}).to_hdf(outpath, 'T_Peaks', append = True, format = 't')
-            i += 1
-            store = pd.read_hdf(path, key = 'Waveforms',start = block_size*i,stop = block_size*(i+1)-1)
+        with engine_context(engine) as eng, HDFWriter(outpath) as out:
+            # chunk_blocks blocks (default 86 = ~1 hour) are read from the file at a time
+            for block_start, core_start, core_stop, times, II in iter_windows(path, block_size, margin, chunk_blocks):
+                waves = []
+                for ind in eng.detect_waves(times, II, 240):
+                    ind = np.asarray(ind, dtype=np.int64)
+                    waves.append(ind[(ind >= core_start) & (ind < core_stop)])
+                Q, P, T = waves
+                out.append('R_Peaks', times[Q], {'Position':times[Q], 'Value':II[Q]})
+                out.append('P_Peaks', times[P], {'Position':times[P], 'Value':II[P]})
+                out.append('T_Peaks', times[T], {'Position':times[T], 'Value':II[T]})
+                n_peaks += len(Q)
+        return n_peaks
     except FileNotFoundError:
         print('File at' + path + 'not found')
         return
     finally:
         print("All Done")
-        eng.quit()
         #ECG.close()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Regression check of waveform_store.TimeIndex against a brute-force mask over every timestamp.
+
+    Synthetic clocks with gaps, changes of sampling rate (240 -> 360 Hz, 240 -> 250 Hz), millisecond rounded
+    timestamps and jitter are indexed whole and in chunks. For random time ranges the rows of rows_between
+    (with and without a reader, see row_after) are compared with (time > t0) & (time <= t1), and the
+    interpolated times of time_of with the stored ones. Exits non-zero on any mismatch.
+
+    TO RUN:
+        python benchmarks/check_time_index.py
+'''
+
+import sys
+import tempfile
+from os.path import abspath, dirname, join
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from waveform_store import TimeIndex, open_waveforms
+
+T0 = 1540000000*10**9 # ns
+
+# Times (ns) of 'seconds' of rows at each rate in turn, with a gap of 'gap' seconds before each part but the first
+def clock(parts, gap=0.0):
+    times, t = [], T0
+    for k, (fs, seconds) in enumerate(parts):
+        if k:
+            t += int(gap*1e9 + 1e9/fs)
+        part = t + np.round(np.arange(int(fs*seconds))*1e9/fs).astype(np.int64)
+        times.append(part)
+        t = part[-1]
+    return np.concatenate(times)
+
+def cases(rng):
+    yield 'regular', clock([(240, 600)])
+    yield 'gaps', clock([(240, 300), (240, 200), (240, 1)], gap=60)
+    yield '240 to 360 Hz', clock([(240, 600), (360, 600)])
+    yield '240 to 250 Hz', clock([(240, 600), (250, 600)])
+    yield '240 to 250 Hz after a gap', clock([(240, 300), (250, 300)], gap=5)
+    yield 'ms rounded', clock([(240, 600), (240, 600)], gap=30)//10**6*10**6
+    yield 'ms rounded 240 to 250 Hz', clock([(240, 600), (250, 600)])//10**6*10**6
+    ns = clock([(240, 1200)])
+    yield '0.1 ms jitter', np.sort(ns + rng.integers(-50000, 50000, len(ns)))
+
+# Mismatches of the index of 'ns' against the brute-force mask in 'queries' random ranges
+def check(name, ns, rng, queries=1000, path=None):
+    index = TimeIndex.from_times(ns.astype('datetime64[ns]'))
+    errors = []
+    for chunk_rows in (1000, 65536):
+        chunked = TimeIndex.from_chunks([ns[i:i+chunk_rows].astype('datetime64[ns]') for i in range(0, len(ns), chunk_rows)])
+        if not (np.array_equal(chunked.starts, index.starts) and np.allclose(chunked.period, index.period)):
+            errors.append('chunks of %d rows give other runs' % chunk_rows)
+    worst = np.abs(index.time_of(np.arange(len(ns))).view(np.int64) - ns).max()
+    if worst > 0.75*np.median(np.diff(ns)):
+        errors.append('time_of off by %d ns' % worst)
+    reader = None
+    if path is not None:
+        pd.DataFrame({'II': np.zeros(len(ns), np.float32)}, index=pd.DatetimeIndex(ns.astype('datetime64[ns]'))).to_hdf(path, key='Waveforms', format='t')
+        reader = open_waveforms(path)
+    wrong = wrong_exact = 0
+    for t0, t1 in np.sort(rng.integers(ns[0]-10**9, ns[-1]+10**9, (queries, 2)), axis=1):
+        rows = np.flatnonzero((ns > t0) & (ns <= t1))
+        expected = (rows[0], rows[-1]) if len(rows) else None
+        for exact in ((False, True) if reader is not None else (False,)):
+            try:
+                found = index.rows_between(pd.Timestamp(t0), pd.Timestamp(t1), reader if exact else None)
+            except IndexError:
+                found = None
+            if found != expected:
+                if exact:
+                    wrong_exact += 1
+                else:
+                    wrong += 1
+    if reader is not None:
+        reader.close()
+    if wrong_exact:
+        errors.append('%d of %d exact lookups wrong' % (wrong_exact, queries))
+    print('%-28s %4d runs, time_of within %7d ns, %4d of %d interpolated lookups off by a row%s' %
+          (name, len(index.starts), worst, wrong, queries, ', ' + '; '.join(errors) if errors else ''))
+    return errors
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for k, (name, ns) in enumerate(cases(rng)):
+            if check(name, ns, rng, path=join(tmp, '%d.hd5' % k)):
+                failed.append(name)
+    print('Failed:', failed if failed else 'none')
+    sys.exit(bool(failed))
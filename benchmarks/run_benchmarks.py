@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Throughput benchmarks for the detector and annotator paths on synthetic recordings (see synthetic_ecg.py).
+
+    Stages:
+        AF                  afib_peak_detector.AF
+        rPeaks              afib_peak_detector.rPeaks
+        comp_AF_ann         Afib_annotation_compare.comp_AF_ann, gold standard episodes against the AF output
+        annotated_graph     AfibAnnotator 'Load Annotated Graph': open the file (min/max pyramid, built on first use)
+                            and helpers.plot_data of the whole recording with the gold standard labels
+
+    Each stage runs in a fresh process so its peak RSS is its own. For every stage the results hold the
+    wall time, segments/sec (30 s segments of signal covered), MB/sec (size of the waveform file) and peak RSS,
+    saved as JSON with the git commit so runs of different versions can be compared (--compare).
+
+    TO RUN:
+        python benchmarks/run_benchmarks.py --hours 24 --engine native --out results.json
+        python benchmarks/run_benchmarks.py --hours 24 --compare old_results.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import resource
+import importlib
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import abspath, dirname, join
+
+REPO = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(1, join(REPO, 'AfibAnnotator'))
+sys.path.insert(2, dirname(abspath(__file__)))
+
+import pandas as pd
+
+from synthetic_ecg import make_recording
+
+STAGES = ['AF', 'rPeaks', 'comp_AF_ann', 'annotated_graph']
+MODULES = {'AF': 'afib_peak_detector', 'rPeaks': 'afib_peak_detector', 'comp_AF_ann': 'Afib_annotation_compare',
+           'annotated_graph': 'helpers'} # imported before timing starts
+LEN_SEG = 30*240 # rows per 30 s segment
+
+def _stage_AF(files, engine):
+    from afib_peak_detector import AF
+    return {'segments': AF(files['wave'], files['af'], engine)}
+
+def _stage_rPeaks(files, engine):
+    from afib_peak_detector import rPeaks
+    return {'r_peaks': rPeaks(files['wave'], files['peaks'], engine)}
+
+def _stage_comp_AF_ann(files, engine):
+    from Afib_annotation_compare import comp_AF_ann
+    from waveform_store import TimeIndex
+    gold = pd.read_hdf(files['gold'], key='AF')
+    machine = pd.read_hdf(files['af'], key='AF')
+    overlap, gold_only, machine_only = comp_AF_ann(gold, machine, 'A', time_index=TimeIndex.load(files['wave']))
+    return {'overlaps': len(overlap), 'gold_only': len(gold_only), 'machine_only': len(machine_only)}
+
+def _stage_annotated_graph(files, engine):
+    from helpers import MinMaxPyramid, WaveformWindow, plot_data
+    t0 = time.time()
+    pyramid = MinMaxPyramid.load(files['wave'])
+    window = WaveformWindow(files['wave'])
+    open_seconds = time.time()-t0
+    df_AF = pd.read_hdf(files['gold'], key='AF')
+    data = plot_data(pyramid, window, 0, window.nrows, 1400, df_AF)
+    window.close()
+    return {'open_seconds': round(open_seconds, 3), 'points_plotted': len(data['index'])}
+
+# Runs one stage in this (fresh) process and returns its measurements
+def _run_stage(stage, files, engine, n_rows):
+    func = globals()['_stage_' + stage]
+    t0 = time.time()
+    try:
+        importlib.import_module(MODULES[stage])
+        t0 = time.time()
+        result = func(files, engine)
+    except Exception as e:
+        result = {'error': type(e).__name__ + ': ' + str(e)}
+    seconds = time.time()-t0
+    result['seconds'] = round(seconds, 3)
+    result['segments_per_sec'] = round(n_rows/LEN_SEG/seconds, 1)
+    result['mb_per_sec'] = round(os.path.getsize(files['wave'])/2**20/seconds, 2)
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1) # KB on Linux
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(hours=1, engine='native', stages=STAGES, work_dir=None, seed=0):
+    work_dir = work_dir or tempfile.mkdtemp(prefix='afib_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    files = {name: join(work_dir, name + '.hd5') for name in ('wave', 'gold', 'af', 'peaks')}
+    for name in ('af', 'peaks'):
+        if os.path.exists(files[name]):
+            os.remove(files[name])
+    print('Generating', hours, 'hour recording in', work_dir)
+    t0 = time.time()
+    fixture = make_recording(files['wave'], files['gold'], hours, seed=seed)
+    fixture['seconds'] = round(time.time()-t0, 1)
+    fixture['file_mb'] = round(os.path.getsize(files['wave'])/2**20, 1)
+    results = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+               'pandas': pd.__version__, 'engine': engine, 'fixture': fixture, 'stages': {}}
+    ctx = multiprocessing.get_context('spawn')
+    for stage in stages:
+        with ProcessPoolExecutor(1, mp_context=ctx) as ex:
+            results['stages'][stage] = ex.submit(_run_stage, stage, files, engine, fixture['rows']).result()
+        print(stage, results['stages'][stage])
+    return results
+
+# Prints the change in seconds and peak RSS of each stage between two results files
+def compare(old, new):
+    for stage, res in new['stages'].items():
+        if stage not in old['stages'] or 'error' in res or 'error' in old['stages'][stage]:
+            continue
+        before = old['stages'][stage]
+        print('%-18s %8.2fs -> %8.2fs (x%.2f)   %8.1fMB -> %8.1fMB' % (stage, before['seconds'], res['seconds'],
+              before['seconds']/max(res['seconds'], 1e-9), before['peak_rss_mb'], res['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark AF detection and annotation stages on synthetic data.')
+    parser.add_argument('--hours', type=float, default=1)
+    parser.add_argument('--engine', default='native', choices=['native', 'matlab'])
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--work-dir', help='where to write the synthetic files (default: a new temporary directory)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--compare', help='results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+    results = run_benchmarks(args.hours, args.engine, args.stages, args.work_dir, args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Saved', args.out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
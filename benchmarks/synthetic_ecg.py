@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Synthetic Bedmaster style recordings for benchmarking (see run_benchmarks.py).
+
+    make_recording writes a 'Waveforms' table like the ICU exports: a DatetimeIndex at fs (240 Hz) and
+    columns I, II, III and V, where II is a synthetic ECG of alternating normal sinus rhythm and AF episodes
+    (irregular RR, no P waves), with injected disconnection runs (-79) and NaN gaps.
+    The injected episodes are also written to a second file in the annotator's format (AF key, index = start row,
+    label 'A' or 'nAF') to act as the gold standard.
+
+    TO RUN:
+        python synthetic_ecg.py out.hd5 out_annotations.hd5 --hours 24
+'''
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+DIS_VALUE = -79 # value of a disconnected lead in the Bedmaster exports
+
+# ECG template of one beat at fs, from 300 ms before to 500 ms after the R peak
+def beat_template(fs, p_wave=True):
+    t = np.arange(-int(0.3*fs), int(0.5*fs))/fs
+    beat = 1.2*np.exp(-(t/0.012)**2) - 0.2*np.exp(-((t-0.03)/0.015)**2) + 0.3*np.exp(-((t-0.3)/0.05)**2)
+    if p_wave:
+        beat += 0.12*np.exp(-((t+0.16)/0.03)**2)
+    return np.arange(-int(0.3*fs), int(0.5*fs)), beat
+
+# Alternating normal/AF episodes covering n rows: (start row, stop row, is AF) with lengths of 2 to 30 minutes
+def make_episodes(n, fs, af_fraction, rng):
+    episodes = []
+    start = 0
+    af = False
+    while start < n:
+        minutes = rng.uniform(2, 30)*(af_fraction if af else 1-af_fraction)*2
+        stop = min(n, start+max(int(minutes*60*fs), fs*60))
+        episodes.append((start, stop, af))
+        start = stop
+        af = not af
+    return episodes
+
+# R peak rows for the episodes: RR ~ N(1, 0.03) of the mean RR in sinus rhythm, U(0.6, 1.4) in AF
+def make_beats(episodes, fs, hr, rng):
+    mean_rr = 60/hr*fs
+    beats = []
+    for start, stop, af in episodes:
+        k = int((stop-start)/mean_rr*1.5)+2
+        rr = mean_rr*(rng.uniform(0.6, 1.4, k) if af else rng.normal(1, 0.03, k))
+        pos = start+np.cumsum(rr)
+        beats.append(pos[pos < stop])
+    return np.round(np.concatenate(beats)).astype(np.int64)
+
+# Lead II for rows start to stop given the beats of the whole recording
+def render(start, stop, beats, af_rows, fs, rng):
+    offsets, normal_beat = beat_template(fs, True)
+    _, af_beat = beat_template(fs, False)
+    x = np.zeros(stop-start)
+    near = beats[(beats >= start+offsets[0]) & (beats < stop+offsets[-1])]
+    for is_af, template in ((False, normal_beat), (True, af_beat)):
+        b = near[af_rows(near) == is_af]
+        pos = (b-start)[:, np.newaxis]+offsets
+        ok = (pos >= 0) & (pos < len(x))
+        np.add.at(x, pos[ok], np.broadcast_to(template, pos.shape)[ok])
+    t = np.arange(start, stop)/fs
+    x += 0.1*np.sin(2*np.pi*0.3*t) + rng.normal(0, 0.03, len(x))
+    return x
+
+# Writes a synthetic recording of 'hours' hours to 'path' (Waveforms key) and the injected episodes to 'ann_path'
+# (AF key, annotator format). 'disconnections' runs of -79 and 'nan_gaps' runs of NaN of 10 s to 2 min are
+# placed at random. Returns a summary dict of what was generated.
+def make_recording(path, ann_path=None, hours=1, fs=240, af_fraction=0.3, disconnections=4, nan_gaps=4,
+                   hr=75, seed=0, start='2018-01-01 00:00:00', chunk_hours=1):
+    rng = np.random.default_rng(seed)
+    n = int(hours*3600*fs)
+    episodes = make_episodes(n, fs, af_fraction, rng)
+    beats = make_beats(episodes, fs, hr, rng)
+    ep_starts = np.array([e[0] for e in episodes])
+    ep_af = np.array([e[2] for e in episodes])
+    af_rows = lambda rows: ep_af[np.searchsorted(ep_starts, rows, 'right')-1]
+    runs = []
+    for value, count in ((DIS_VALUE, disconnections), (np.nan, nan_gaps)):
+        for _ in range(count):
+            length = int(rng.uniform(10, 120)*fs)
+            s = int(rng.integers(0, max(n-length, 1)))
+            runs.append((s, s+length, value))
+    t0 = pd.Timestamp(start).value
+    chunk = int(chunk_hours*3600*fs)
+    with pd.HDFStore(path, mode='w') as store:
+        for s in range(0, n, chunk):
+            e = min(s+chunk, n)
+            ii = render(s, e, beats, af_rows, fs, rng)
+            for rs, re, value in runs:
+                if rs < e and re > s:
+                    ii[max(rs, s)-s:min(re, e)-s] = value
+            index = pd.DatetimeIndex(t0+np.round(np.arange(s, e)*1e9/fs).astype(np.int64))
+            df = pd.DataFrame({'I': ii*0.6, 'II': ii, 'III': ii*0.4, 'V': ii*1.1}, index=index)
+            store.append('Waveforms', df, format='t', index=False)
+    if ann_path is not None:
+        labels = ['A' if af else 'nAF' for _, _, af in episodes]
+        pd.DataFrame(labels, index=ep_starts, columns=[0]).to_hdf(ann_path, key='AF', format='t')
+    return {'rows': n, 'fs': fs, 'hours': hours, 'episodes': len(episodes), 'af_episodes': int(ep_af.sum()),
+            'beats': len(beats), 'disconnections': disconnections, 'nan_gaps': nan_gaps}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic 240 Hz Waveforms recording with AF episodes.')
+    parser.add_argument('path')
+    parser.add_argument('ann_path', nargs='?')
+    parser.add_argument('--hours', type=float, default=1)
+    parser.add_argument('--af-fraction', type=float, default=0.3)
+    parser.add_argument('--disconnections', type=int, default=4)
+    parser.add_argument('--nan-gaps', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(make_recording(args.path, args.ann_path, args.hours, af_fraction=args.af_fraction,
+                         disconnections=args.disconnections, nan_gaps=args.nan_gaps, seed=args.seed))
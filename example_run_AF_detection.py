@@ -7,18 +7,22 @@ Example of how to use AF detection algorithm as in afib_peak_detector.py
 
 Major Dependencies:
 	afib_peak_detector	-functions that run the Computing in Cardiology detection algorithms
+	run_AF_batch		-runs AF over a directory with a pool of workers, resuming interrupted runs
         Python modules (sys, time and os)
 '''
 
-in_path = '.'
-files = get_files_from_dir(in_path)
+import os
 
-for case in files:
-    file_path = '/files/'+case
-    #rpeaks_out_path = '/mnt/data04/Conduit/afib/new_files/peaks/'+case
-    af_out_path = '/af/'+case
-    if os.path.exists(af_out_path) == False:    
-        print("Processing: ", case)
-        AF(file_path, af_out_path)
-    else:
-        continue
+from afib_peak_detector import AF
+from run_AF_batch import run_batch
+
+in_path = '/files/'
+af_out_path = '/af/'
+#rpeaks_out_path = '/mnt/data04/Conduit/afib/new_files/peaks/'
+
+if __name__ == '__main__':
+    # one file
+    #AF(os.path.join(in_path, case), os.path.join(af_out_path, case), engine='matlab')
+    # every file in in_path, one engine per worker, skipping files already done (see manifest.json in af_out_path)
+    # (engine='native' runs the NumPy classifier instead of the challenge code, without MATLAB)
+    run_batch(in_path, af_out_path, engine='matlab', workers=os.cpu_count())
@@ -2,24 +2,29 @@
 # -*- coding: utf-8 -*-
 """
 Based on Phil's slice_hd5 code.
-Used to get first hour of waveform data from hd5 file.
+Used to get first hour of waveform data from hd5 files.
 
+    Slices every file of in_path to the file of the same name in out_path (see slice_hd5.py), in parallel,
+    skipping files already processed.
+
+    TO RUN:
+        python get_first_hour_hd5.py /files /new_files/1hour [hours] [workers]
 """
 
 import sys
 import os
-import pandas as pd
-import csv
-
-from slice_hd5 import slice_hd5
 
-in_path = sys.argv[1] #to use when the full directory is to be processed
-out_path = sys.argv[2]
+from slice_hd5 import slice_hd5, slice_directory
 
 def get_first_hour(filename, in_dir, out_dir, time_hrs):
     in_full_path = os.path.join(in_dir, filename)
     out_full_path = os.path.join(out_dir, filename)
     if os.path.exists(out_full_path) == False: #skip those already processed
         slice_hd5(in_full_path, out_full_path, None, time_hrs)
-        
-get_first_hour(filename,in_path,out_path,'1 hours')
+
+if __name__ == '__main__':
+    in_path = sys.argv[1] #the full directory is processed
+    out_path = sys.argv[2]
+    hours = sys.argv[3] if len(sys.argv) > 3 else '1'
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+    sys.exit(bool(slice_directory(in_path, out_path, None, hours + ' hours', workers)))
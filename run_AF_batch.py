@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Batch AF detection over a directory of hd5 files using a pool of worker processes.
+
+    Each worker starts one classifier engine (an afib_peak_detector.EnginePool of size 1) when it is created
+    and keeps it for every file it processes, for both AF() and, with --peaks-dir, rPeaks(). A file whose
+    engine died while it was being processed is retried once on the restarted engine.
+    Output is written to '<case>.tmp' in the output directory and renamed to '<case>' only once AF() has
+    finished, so an output file always holds a complete AF key (likewise for the peaks directory).
+
+    Progress is kept in 'manifest.json' in the output directory:
+        {"<case>": {"status": "done" | "failed" | "running", "segments": 2880, "seconds": 12.3, "error": "..."}}
+    On restart, files marked done are skipped, files marked running (interrupted) are processed again
+    and failed files are retried only with --retry-failed. Outputs with no manifest entry (from earlier
+    serial runs) are treated as done.
+
+    Major Dependencies:
+        afib_peak_detector  -AF detection
+        Python modules (os, json, multiprocessing)
+
+    TO RUN:
+        python run_AF_batch.py /files /af --workers 32 --engine native
+        python run_AF_batch.py /files /af --workers 8 --engine matlab --peaks-dir /peaks
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.util import Finalize
+
+from afib_peak_detector import AF, rPeaks, EnginePool
+
+MANIFEST = 'manifest.json'
+
+_pool = None # engine pool of this worker process
+
+def _init_worker(engine_name):
+    global _pool
+    _pool = EnginePool(engine_name, size=1)
+    Finalize(_pool, _pool.close, exitpriority=10)
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+# Runs func(in_path, tmp_path, pool) and renames tmp_path to out_path once it has finished
+def _run_stage(func, in_path, out_path, *args):
+    tmp_path = out_path + '.tmp'
+    _remove(tmp_path) # left over from an interrupted run
+    try:
+        n = func(in_path, tmp_path, _pool, *args)
+        if n is None:
+            raise RuntimeError('no Waveforms to process')
+        os.replace(tmp_path, out_path)
+        return n
+    finally:
+        _remove(tmp_path)
+
+# Runs AF() (and rPeaks() when peaks_dir is given) on one case in a worker. Returns (case, manifest entry)
+def _process(case, in_dir, out_dir, chunk_segments, peaks_dir=None):
+    in_path = os.path.join(in_dir, case)
+    t0 = time.time()
+    for attempt in range(2):
+        restarts = _pool.restarts
+        try:
+            entry = {'status': 'done'}
+            entry['segments'] = _run_stage(AF, in_path, os.path.join(out_dir, case), chunk_segments)
+            if peaks_dir is not None:
+                entry['r_peaks'] = _run_stage(rPeaks, in_path, os.path.join(peaks_dir, case))
+            entry['seconds'] = round(time.time()-t0, 1)
+            return case, entry
+        except Exception:
+            error = traceback.format_exc()
+            if _pool.restarts == restarts: # the engine is fine, retrying would fail the same way
+                break
+    return case, {'status': 'failed', 'seconds': round(time.time()-t0, 1), 'error': error}
+
+def _star_process(args):
+    return _process(*args)
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# Written to a temporary file and renamed so a crash never leaves a truncated manifest
+def save_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+# Cases in in_dir still to be processed given the manifest and the outputs in out_dir
+def pending_cases(in_dir, out_dir, manifest, retry_failed=False, extension='.hd5'):
+    cases = []
+    for case in sorted(os.listdir(in_dir)):
+        if not case.endswith(extension):
+            continue
+        status = manifest.get(case, {}).get('status')
+        if status == 'done' and os.path.exists(os.path.join(out_dir, case)):
+            continue
+        if status is None and os.path.exists(os.path.join(out_dir, case)):
+            continue
+        if status == 'failed' and not retry_failed:
+            continue
+        cases.append(case)
+    return cases
+
+def run_batch(in_dir, out_dir, engine='matlab', workers=os.cpu_count(), retry_failed=False, chunk_segments=120, extension='.hd5', peaks_dir=None):
+    os.makedirs(out_dir, exist_ok=True)
+    if peaks_dir is not None:
+        os.makedirs(peaks_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    cases = pending_cases(in_dir, out_dir, manifest, retry_failed, extension)
+    print("Processing", len(cases), "files with", workers, "workers")
+    if not cases:
+        return manifest
+    for case in cases:
+        manifest[case] = {'status': 'running'}
+    save_manifest(out_dir, manifest)
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(engine,)) as pool:
+        jobs = [(case, in_dir, out_dir, chunk_segments, peaks_dir) for case in cases]
+        for case, entry in pool.imap_unordered(_star_process, jobs):
+            manifest[case] = entry
+            save_manifest(out_dir, manifest)
+            print(entry['status'], case, entry.get('segments', ''))
+    failed = [case for case in cases if manifest[case]['status'] == 'failed']
+    print("Done:", len(cases)-len(failed), "Failed:", len(failed))
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run AF detection on every hd5 file in a directory.')
+    parser.add_argument('in_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', default='matlab', choices=['matlab', 'native'])
+    parser.add_argument('--retry-failed', action='store_true')
+    parser.add_argument('--chunk-segments', type=int, default=120)
+    parser.add_argument('--peaks-dir', help='also write R, P and T peaks for each file to this directory')
+    args = parser.parse_args()
+    manifest = run_batch(args.in_dir, args.out_dir, args.engine, args.workers, args.retry_failed, args.chunk_segments, peaks_dir=args.peaks_dir)
+    sys.exit(any(entry['status'] == 'failed' for entry in manifest.values()))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Time window of hd5 files (the first hour of each recording for annotation, or any t0 to t1).
+
+    slice_hd5(in_path, out_path, start, duration) copies the rows with start <= time < start+duration of every
+    table key to out_path; start None is the first timestamp of the Waveforms key and duration is anything
+    pd.Timedelta takes ('1 hours', 3600 s). Tables are streamed 'chunk_rows' at a time, so no key is loaded whole:
+        Waveforms               rows found from its time index (waveform_store.TimeIndex, cached next to the file)
+                                and checked against the stored times around them
+        other time indexed keys selected with a where on the index
+        keys not indexed by time (AF labels, which index rows of the whole file) are left out
+    The output is written to '<out>.tmp' and renamed once complete, so slice_directory can skip the files whose
+    output exists.
+
+    Major Dependencies:
+        waveform_store  -TimeIndex
+
+    TO RUN:
+        python slice_hd5.py /files /new_files/1hour --duration "1 hours" --workers 16
+        python slice_hd5.py /files /new_files/window --start "2018-10-20 02:00" --duration "6 hours"
+'''
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+import pandas as pd
+
+from waveform_store import TimeIndex, open_waveforms
+
+# Largest string width of each string column of the table 'key' in store (so later chunks fit the output table)
+def _min_itemsize(store, key):
+    storer = store.get_storer(key)
+    sizes = {}
+    for col in storer.values_axes:
+        if col.kind == 'string':
+            if col.name in storer.data_columns:
+                sizes[col.name] = col.itemsize
+            else:
+                sizes['values'] = max(sizes.get('values', 0), col.itemsize)
+    return sizes
+
+# Appends the chunks (DataFrames) to the table 'key' of out, as in the input table. Returns the number of rows
+def _copy_chunks(out, store, key, chunks):
+    data_columns = store.get_storer(key).data_columns
+    min_itemsize = _min_itemsize(store, key) or None
+    n = 0
+    for chunk in chunks:
+        out.append(key, chunk, format='t', index=False, data_columns=data_columns, min_itemsize=min_itemsize)
+        n += len(chunk)
+    return n
+
+# Copies the rows with start <= time < start+duration (or < end) of the table keys of the hd5 file at in_path to
+# out_path. Returns {key: rows copied}; keys with no time index are left out (None)
+def slice_hd5(in_path, out_path, start=None, duration=None, end=None, key='Waveforms', chunk_rows=2**20):
+    time_index = TimeIndex.load(in_path, key=key)
+    t0 = pd.Timestamp(time_index.t0[0]) if start is None else pd.Timestamp(start)
+    t1 = t0 + pd.Timedelta(duration) if duration is not None else pd.Timestamp(end) if end is not None else None
+    one = pd.Timedelta(1, 'ns')
+    with open_waveforms(in_path, key) as wf:
+        first = time_index.row_after(t0-one, wf)
+        last = time_index.row_after(t1-one, wf) if t1 is not None else time_index.nrows
+    rows = {}
+    tmp_path = out_path + '.tmp'
+    try:
+        with pd.HDFStore(in_path, mode='r') as store, pd.HDFStore(tmp_path, mode='w') as out:
+            for k in store.keys():
+                k = k.lstrip('/')
+                if k == key:
+                    chunks = (store.select(k, start=s, stop=min(s+chunk_rows, last)) for s in range(first, last, chunk_rows))
+                    rows[k] = _copy_chunks(out, store, k, chunks)
+                elif not store.get_storer(k).is_table:
+                    frame = store.select(k) # fixed format keys are small and can only be read whole
+                    rows[k] = None
+                    if isinstance(frame.index, pd.DatetimeIndex):
+                        frame = frame[frame.index >= t0]
+                        if t1 is not None:
+                            frame = frame[frame.index < t1]
+                        out.put(k, frame)
+                        rows[k] = len(frame)
+                elif isinstance(store.select(k, start=0, stop=1).index, pd.DatetimeIndex):
+                    where = 'index >= t0' if t1 is None else 'index >= t0 & index < t1'
+                    rows[k] = _copy_chunks(out, store, k, store.select(k, where=where, chunksize=chunk_rows))
+                else:
+                    rows[k] = None
+        os.replace(tmp_path, out_path)
+        return rows
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Slices one file unless its output exists. Returns (file, rows or None when skipped, error)
+def _slice_file(args):
+    in_path, out_path, start, duration = args
+    if os.path.exists(out_path):
+        return in_path, None, None
+    try:
+        return in_path, slice_hd5(in_path, out_path, start, duration), None
+    except Exception as e:
+        return in_path, None, '%s: %s' % (type(e).__name__, e)
+
+# Slices every file of in_dir to the file of the same name in out_dir, in 'workers' processes
+def slice_directory(in_dir, out_dir, start=None, duration='1 hours', workers=os.cpu_count(), extension='.hd5'):
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(os.path.join(in_dir, f), os.path.join(out_dir, f), start, duration)
+            for f in sorted(os.listdir(in_dir)) if f.endswith(extension)]
+    t0 = time.time()
+    failed = []
+    with multiprocessing.Pool(workers) as pool:
+        for path, rows, error in pool.imap_unordered(_slice_file, jobs):
+            if error is not None:
+                failed.append(path)
+            print('failed' if error else 'skipped' if rows is None else 'sliced', path, error or rows or '')
+    print("Done:", len(jobs)-len(failed), "Failed:", len(failed), "in", round(time.time()-t0, 1), "s")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy a time window of every hd5 file in a directory.')
+    parser.add_argument('in_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--start', help='start time (default: start of each recording)')
+    parser.add_argument('--duration', default='1 hours')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    sys.exit(bool(slice_directory(args.in_dir, args.out_dir, args.start, args.duration, args.workers)))
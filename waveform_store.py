@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Columnar cache of the Waveforms tables and the reader used by the AF detector and the annotator.
+
+    The Bedmaster exports keep the Waveforms key as a row-oriented PyTables table, so reading lead II decodes
+    every lead. convert() writes the table once to '<file>.parquet' next to '<file>.hd5': a 'time' column
+    (timestamp, ns) and one float32 column per lead, zstd compressed, in row groups of 'row_group_seconds' of
+    signal. A column and row (or time) range can then be read by decoding only the row groups and column needed.
+
+    open_waveforms(path) returns a reader over the parquet cache when there is one at least as new as the hd5
+    file, and over the hd5 table otherwise, so every entry point works with or without converting:
+        with open_waveforms(path) as wf:
+            times, values = wf.read(start, stop, 'II')
+            first, last = wf.rows_between(t0, t1)
+
+    Major Dependencies:
+        pyarrow     -parquet files (only needed to convert and read the cache)
+
+    TO RUN:
+        python waveform_store.py /files --workers 8
+'''
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import tempfile
+import multiprocessing
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # the parquet cache is optional, readers fall back to the hd5 tables
+    pa = pq = None
+
+# Parquet cache of the Waveforms table in the hd5 file at path
+def cache_path(path):
+    return os.path.splitext(path)[0] + '.parquet'
+
+# Writes the arrays to the npz file at path through a temporary file of its own in the same directory, renamed
+# once complete, so concurrent writers (or readers) of the same cache never see a partial file
+def save_npz(path, **arrays):
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.chmod(tmp_path, 0o644) #mkstemp creates it private to the user
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Rows of the 'key' table in an hd5 file, read by row or time range
+class HDFWaveforms:
+    def __init__(self, path, key='Waveforms'):
+        self.store = pd.HDFStore(path, mode='r')
+        self.key = key
+        self.nrows = self.store.get_storer(key).nrows
+
+    @property
+    def columns(self):
+        return list(self.store.select(self.key, start=0, stop=1).columns)
+
+    # Timestamps (datetime64[ns]) and values of 'column' for rows start to stop
+    def read(self, start, stop, column='II'):
+        block = self.store.select(self.key, start=start, stop=stop, columns=[column])
+        return block.index.values, block[column].values
+
+    def read_times(self, start, stop):
+        return self.store.select(self.key, start=start, stop=stop, columns=[]).index.values
+
+    # First and last row with t0 < time <= t1, IndexError when there are none
+    def rows_between(self, t0, t1):
+        t0, t1 = pd.Timestamp(t0), pd.Timestamp(t1)
+        rows = self.store.select_as_coordinates(self.key, where='index > t0 & index <= t1')
+        return rows[0], rows[-1]
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Rows of a parquet cache written by convert(), decoding only the row groups and column read
+class ParquetWaveforms:
+    def __init__(self, path):
+        if pq is None:
+            raise ImportError('pyarrow is needed to read ' + path)
+        self.file = pq.ParquetFile(path)
+        meta = self.file.metadata
+        self.nrows = meta.num_rows
+        self.offsets = np.cumsum([0] + [meta.row_group(i).num_rows for i in range(meta.num_row_groups)])
+        self.columns = [name for name in self.file.schema_arrow.names if name != 'time']
+        self._group = (None, None) # last row group read, (index, table), as readers often stay in one
+
+    def _read_group(self, i, column):
+        if self._group[0] != (i, column):
+            self._group = ((i, column), self.file.read_row_group(i, columns=['time', column]))
+        return self._group[1]
+
+    def read(self, start, stop, column='II'):
+        start, stop = max(start, 0), min(stop, self.nrows)
+        if stop <= start:
+            return np.empty(0, 'datetime64[ns]'), np.empty(0, np.float32)
+        first = np.searchsorted(self.offsets, start, 'right')-1
+        last = np.searchsorted(self.offsets, stop, 'left')
+        groups = [self._read_group(i, column) for i in range(first, last)]
+        table = groups[0] if len(groups) == 1 else pa.concat_tables(groups)
+        table = table.slice(start-self.offsets[first], stop-start)
+        times = table.column('time').to_numpy().astype('datetime64[ns]')
+        return times, table.column(column).to_numpy()
+
+    def read_times(self, start, stop):
+        start, stop = max(start, 0), min(stop, self.nrows)
+        first = np.searchsorted(self.offsets, start, 'right')-1
+        last = np.searchsorted(self.offsets, stop, 'left')
+        table = self.file.read_row_groups(list(range(first, last)), columns=['time'])
+        return table.slice(start-self.offsets[first], stop-start).column('time').to_numpy().astype('datetime64[ns]')
+
+    # Row groups are found from the time statistics in the file footer and only their times are decoded
+    def rows_between(self, t0, t1):
+        t0, t1 = pd.Timestamp(t0).to_datetime64(), pd.Timestamp(t1).to_datetime64()
+        meta = self.file.metadata
+        col = self.file.schema_arrow.get_field_index('time')
+        for i in range(meta.num_row_groups):
+            stats = meta.row_group(i).column(col).statistics
+            if pd.Timestamp(stats.max).to_datetime64() <= t0:
+                continue
+            times = self.file.read_row_group(i, columns=['time']).column('time').to_numpy().astype('datetime64[ns]')
+            a = self.offsets[i] + np.searchsorted(times, t0, 'right')
+            break
+        else:
+            raise IndexError('no rows after %s' % t0)
+        for j in range(i, meta.num_row_groups):
+            stats = meta.row_group(j).column(col).statistics
+            if pd.Timestamp(stats.max).to_datetime64() > t1:
+                break
+        j = min(j, meta.num_row_groups-1)
+        times = self.file.read_row_group(j, columns=['time']).column('time').to_numpy().astype('datetime64[ns]')
+        b = self.offsets[j] + np.searchsorted(times, t1, 'right')
+        if b <= a:
+            raise IndexError('no rows between %s and %s' % (t0, t1))
+        return a, b-1
+
+    def close(self):
+        self._group = (None, None)
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Reader for the 'key' table of the recording at path: its parquet cache when it is up to date (or path is one),
+# the hd5 table otherwise
+def open_waveforms(path, key='Waveforms'):
+    if path.endswith('.parquet'):
+        return ParquetWaveforms(path)
+    cache = cache_path(path)
+    if key == 'Waveforms' and pq is not None and os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return ParquetWaveforms(cache)
+    return HDFWaveforms(path, key)
+
+# Timestamps of a recording as runs of regularly sampled rows and the gaps between them, so the time of a row
+# and the rows in a time range are found by binary search over the runs instead of over every timestamp.
+# Run k covers rows starts[k] to starts[k+1] (nrows for the last) with times t0[k] + (row-starts[k])*period[k] (ns);
+# a new run starts at the first row whose time is more than 'tolerance' of a period away from t0 + k*period of the
+# current run (a gap, or a change of sampling rate however small once it has drifted that far).
+# Within a run, times are those of the first and last row interpolated, so they are within a nanosecond of the
+# stored ones for a clock with no jitter and otherwise within about 'tolerance' of a period (row_after and
+# rows_between given a reader check the stored times). Built once per recording and saved as '<file>.timeindex.npz'.
+class TimeIndex:
+    version = 2 # of the way runs are found; saved indexes of other versions are rebuilt
+
+    def __init__(self, starts, t0, period, nrows):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.t0 = np.asarray(t0, dtype=np.int64)
+        self.period = np.asarray(period, dtype=np.float64)
+        self.nrows = int(nrows)
+        self.t_end = self.t0 + np.round(self.period*(np.diff(np.append(self.starts, self.nrows))-1)).astype(np.int64)
+
+    @staticmethod
+    def cache_path(path):
+        return os.path.splitext(path)[0] + '.timeindex.npz'
+
+    # Runs of a sorted datetime64 array of the times of every row
+    @classmethod
+    def from_times(cls, times, tolerance=0.5):
+        return cls.from_chunks([times], tolerance)
+
+    # Runs of the times of every row given in consecutive chunks (datetime64 arrays). The rows after those of the
+    # current run are checked against its line in blocks of a quarter as many as it has (up to max_block), and the
+    # period is then updated from its first and last rows, so it is known well enough to tell jitter from drift.
+    # Rows of a block cut by the end of a chunk wait for the next one, so the runs do not depend on the chunks
+    @classmethod
+    def from_chunks(cls, chunks, tolerance=0.5, max_block=2**16):
+        starts, first, last = [], [], [] # first row of each run, time of its first and of its last row
+        t0 = period = None # time of the first row and period of the current run (None until its second row)
+        n, t_last = 0, None # rows of the current run so far and time of its last one
+        pending, row = np.empty(0, np.int64), 0 # rows not checked yet and the row of the first of them
+        for times in itertools.chain(chunks, [None]):
+            final = times is None
+            ns = pending if final else np.append(pending, np.asarray(times).astype('datetime64[ns]').view(np.int64))
+            i = 0
+            while i < len(ns):
+                if n == 0 or (n == 1 and ns[i] == t0): # first row of a run (duplicate times start another)
+                    if n:
+                        last.append(t_last)
+                    starts.append(row+i)
+                    first.append(ns[i])
+                    t0, t_last, n, i = ns[i], ns[i], 1, i+1
+                    continue
+                if n == 1:
+                    period, t_last, n, i = float(ns[i]-t0), ns[i], 2, i+1
+                    continue
+                size = min(max(1, n//4), max_block)
+                if i+size > len(ns) and not final:
+                    break
+                block = ns[i:i+size]
+                drift = np.abs(block - t0 - np.round(np.arange(n, n+len(block))*period))
+                out = np.flatnonzero(drift > tolerance*period)
+                taken = out[0] if len(out) else len(block)
+                if taken:
+                    n += taken
+                    t_last = block[taken-1]
+                    period = (t_last-t0)/(n-1)
+                if len(out):
+                    last.append(t_last)
+                    n = 0
+                i += taken
+            pending, row = ns[i:], row+i
+        if not starts:
+            return cls([], [], [], 0)
+        if n:
+            last.append(t_last)
+        lengths = np.diff(np.append(starts, row))
+        periods = (np.array(last)-np.array(first))/np.maximum(lengths-1, 1)
+        single = lengths == 1 # no step of their own, only used for the time of their one row
+        periods[single] = np.median(periods[~single]) if not single.all() else 0.0
+        return cls(starts, first, periods, row)
+
+    # Reads the times of the recording (only the time column of its parquet cache when there is one) in chunks,
+    # holding 'lock' (e.g. the annotator's hdf_lock) only while a chunk is read
+    @classmethod
+    def build(cls, path, key='Waveforms', chunk_rows=2**22, tolerance=0.5, lock=None):
+        lock = lock or nullcontext()
+        with lock:
+            wf = open_waveforms(path, key)
+        def chunks():
+            for start in range(0, wf.nrows, chunk_rows):
+                with lock:
+                    times = wf.read_times(start, min(start+chunk_rows, wf.nrows))
+                yield times
+        try:
+            return cls.from_chunks(chunks(), tolerance)
+        finally:
+            with lock:
+                wf.close()
+
+    # Cached time index of the recording at path, built and saved (when the directory is writable) if missing or
+    # stale. kwargs go to build()
+    @classmethod
+    def load(cls, path, **kwargs):
+        cache = cls.cache_path(path)
+        if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+            with np.load(cache) as f:
+                if 'version' in f and int(f['version']) == cls.version:
+                    return cls(f['starts'], f['t0'], f['period'], int(f['nrows']))
+        index = cls.build(path, **kwargs)
+        try:
+            save_npz(cache, starts=index.starts, t0=index.t0, period=index.period, nrows=index.nrows, version=cls.version)
+        except OSError as e:
+            print("Could not save", cache, e)
+        return index
+
+    # Gaps between runs: (row after the gap, time before it, time after it) in ns
+    @property
+    def gaps(self):
+        return self.starts[1:], self.t_end[:-1], self.t0[1:]
+
+    # Timestamp (datetime64[ns]) of rows (an int or an array), interpolated in their run (so within the jitter of
+    # the stored times), or the stored times read one row at a time with 'reader' (an open reader of the recording)
+    def time_of(self, rows, reader=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        if reader is not None:
+            return np.array([reader.read_times(r, r+1)[0] for r in rows.reshape(-1)], dtype='datetime64[ns]').reshape(rows.shape)
+        k = np.searchsorted(self.starts, rows, 'right')-1
+        ns = self.t0[k] + np.round((rows-self.starts[k])*self.period[k]).astype(np.int64)
+        return ns.astype('datetime64[ns]')
+
+    # First row with time > t (nrows if none), t a timestamp or datetime64. The row found from the runs is
+    # within the jitter of the clock; with 'reader' (an open reader of the recording, see open_waveforms) it is
+    # checked against the stored times of the rows around it, so it is exact
+    def row_after(self, t, reader=None):
+        row = self._row_after(t)
+        if reader is None or self.nrows == 0:
+            return row
+        t = pd.Timestamp(t).to_datetime64()
+        width = 4
+        while True: # widened until the stored times around the row bracket t
+            a, b = max(row-width, 0), min(row+width, self.nrows)
+            times = reader.read_times(a, b)
+            i = int(np.searchsorted(times, t, 'right'))
+            if (i > 0 or a == 0) and (i < len(times) or b == self.nrows):
+                return a+i
+            width *= 4
+
+    def _row_after(self, t):
+        t = pd.Timestamp(t).value
+        k = np.searchsorted(self.t0, t, 'right')-1
+        if k < 0:
+            return 0
+        if t >= self.t_end[k]: # in the gap after run k (or after the end)
+            return int(self.starts[k+1]) if k+1 < len(self.starts) else self.nrows
+        i = int(np.floor((t-self.t0[k])/self.period[k]))+1
+        while i > 0 and self.t0[k]+round((i-1)*self.period[k]) > t: # rounding of the interpolated times
+            i -= 1
+        while self.t0[k]+round(i*self.period[k]) <= t:
+            i += 1
+        return int(self.starts[k])+i
+
+    # First and last row with t0 < time <= t1, IndexError when there are none (reader as for row_after)
+    def rows_between(self, t0, t1, reader=None):
+        a, b = self.row_after(t0, reader), self.row_after(t1, reader)
+        if b <= a:
+            raise IndexError('no rows between %s and %s' % (t0, t1))
+        return a, b-1
+
+# Writes the Waveforms table of the hd5 file at path to its parquet cache (or 'out'), 'row_group_seconds'
+# of signal (at fs) per row group. Written to a temporary file and renamed, so a cache is always complete.
+# Returns the number of rows
+def convert(path, out=None, key='Waveforms', fs=240, row_group_seconds=600, compression='zstd'):
+    if pq is None:
+        raise ImportError('pyarrow is needed to convert to parquet')
+    out = out or cache_path(path)
+    rows = fs*row_group_seconds
+    writer = None
+    try:
+        with pd.HDFStore(path, mode='r') as store:
+            nrows = store.get_storer(key).nrows
+            for start in range(0, nrows, rows):
+                block = store.select(key, start=start, stop=min(start+rows, nrows))
+                if isinstance(block, pd.Series):
+                    block = block.to_frame()
+                columns = {'time': pa.array(block.index.values.astype('datetime64[ns]'))}
+                columns.update({str(c): pa.array(block[c].to_numpy(dtype=np.float32)) for c in block.columns})
+                table = pa.table(columns)
+                if writer is None:
+                    writer = pq.ParquetWriter(out + '.tmp', table.schema, compression=compression)
+                writer.write_table(table, row_group_size=rows)
+        if writer is None: # empty table
+            raise ValueError('no rows in ' + key)
+        writer.close()
+        writer = None
+        os.replace(out + '.tmp', out)
+        return nrows
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(out + '.tmp'):
+            os.remove(out + '.tmp')
+
+# Converts one file unless its cache is up to date. Returns (path, rows or None when skipped, error)
+def _convert_file(path):
+    cache = cache_path(path)
+    if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return path, None, None
+    try:
+        return path, convert(path), None
+    except Exception as e:
+        return path, None, '%s: %s' % (type(e).__name__, e)
+
+def convert_directory(in_dir, workers=os.cpu_count(), extension='.hd5'):
+    paths = [os.path.join(in_dir, f) for f in sorted(os.listdir(in_dir)) if f.endswith(extension)]
+    t0 = time.time()
+    failed = []
+    with multiprocessing.Pool(workers) as pool:
+        for path, nrows, error in pool.imap_unordered(_convert_file, paths):
+            if error is not None:
+                failed.append(path)
+            print('failed' if error else 'skipped' if nrows is None else 'converted', path, error or nrows or '')
+    print("Done:", len(paths)-len(failed), "Failed:", len(failed), "in", round(time.time()-t0, 1), "s")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a parquet cache of the Waveforms table of every hd5 file in a directory.')
+    parser.add_argument('in_dir')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    sys.exit(bool(convert_directory(args.in_dir, args.workers)))